@@ -2,18 +2,23 @@
 """
 Vimly — Client Demo Bot (FastAPI + aiogram 3.7+)
 Пересборка: WebApp и браузерный квиз шлют ТОЛЬКО в лид-группу (одно сообщение).
-Добавлены: /stats, явные логи WEBAPP DATA RAW, безопасные ответы, самотесты.
+Добавлены: /stats, структурные (JSON) логи с сэмплированием, безопасные ответы, самотесты.
 """
 
-import os, logging, re, asyncio, json, html, secrets
+import os, logging, logging.handlers, queue, random, atexit, re, asyncio, json, html, secrets, sqlite3, threading, time, heapq, hashlib, hmac, math, socket, gzip, mimetypes, io, traceback, copy
+from urllib.parse import parse_qsl
+from collections import OrderedDict
 from datetime import datetime, timezone, timedelta
-from typing import Optional
+from typing import NamedTuple, Optional
 
-from fastapi import FastAPI, Request, HTTPException, Response, Body
+from fastapi import FastAPI, Request, HTTPException, Response
 from fastapi.responses import HTMLResponse, PlainTextResponse, FileResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
 
-from aiogram import Bot, Dispatcher, F
+from aiogram import Bot, Dispatcher, F, BaseMiddleware
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.filters import Command, CommandStart
 from aiogram.types import (
     Message, CallbackQuery, Update,
@@ -21,9 +26,12 @@ from aiogram.types import (
     ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove,
     ForceReply, FSInputFile,
 )
-from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from aiogram.types.update import UpdateTypeLookupError
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType
+from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
 
@@ -34,6 +42,21 @@ try:
 except Exception:
     pass
 
+try:
+    import orjson   # необязательно: быстрее json для тел запросов
+except ImportError:
+    orjson = None
+
+try:
+    import brotli   # необязательно: br-варианты статики WebApp
+except ImportError:
+    brotli = None
+
+try:
+    from PIL import Image   # необязательно: фавикон и облегчённый hero из assets/hero.png
+except ImportError:
+    Image = None
+
 def _norm_base_url(s: str) -> str:
     s = (s or "").strip()
     return s[:-1] if s.endswith("/") else s
@@ -61,16 +84,61 @@ if not LEADS_RAW.startswith("@"):
         raise RuntimeError("Invalid LEADS_CHAT_ID env var")
 
 LEADS_THREAD_ID = int((os.getenv("LEADS_THREAD_ID") or "0").strip() or "0")  # 0 если тем нет
+LEADS_ROUTES = (os.getenv("LEADS_ROUTES") or "").strip()  # "webapp=-100…; order:pro=-100…/12" — поверх LEADS_CHAT_ID
 LEADS_FAIL_MSG = "⚠️ Лид-чат временно недоступен — админ уведомлён."
 
 BASE_URL = _norm_base_url(os.getenv("BASE_URL"))
 WEBHOOK_PATH = _norm_path(os.getenv("WEBHOOK_PATH") or "/telegram/webhook/vimly")
 WEBHOOK_SECRET = (os.getenv("WEBHOOK_SECRET") or "").strip()
 MODE = (os.getenv("MODE") or "webhook").strip().lower()  # webhook | polling
+TELEGRAM_API_URL = _norm_base_url(os.getenv("TELEGRAM_API_URL"))  # свой Bot API сервер (локальный/стаб для bench/); пусто — api.telegram.org
+WEBHOOK_ACK_FIRST = (os.getenv("WEBHOOK_ACK_FIRST") or "1").strip().lower() not in {"0", "false", "no"}  # 200 сразу, апдейт — в очередь
+WEBHOOK_WORKERS = int((os.getenv("WEBHOOK_WORKERS") or "8").strip() or "8")
+WEBHOOK_QUEUE_SIZE = int((os.getenv("WEBHOOK_QUEUE_SIZE") or "1000").strip() or "1000")  # на всех воркеров; сверх — 503
+WEBHOOK_DRAIN_TIMEOUT_SEC = float((os.getenv("WEBHOOK_DRAIN_TIMEOUT_SEC") or "20").strip() or "20")
+CATCHUP_ON_START = (os.getenv("CATCHUP_ON_START") or "1").strip().lower() not in {"0", "false", "no"}  # 0 — как раньше: drop_pending_updates
+CATCHUP_CONCURRENCY = int((os.getenv("CATCHUP_CONCURRENCY") or "32").strip() or "32")      # чатов параллельно при дочитке
+CATCHUP_MAX_UPDATES = int((os.getenv("CATCHUP_MAX_UPDATES") or "5000").strip() or "5000")  # остальное придёт вебхуком
+CATCHUP_MAX_SEC = float((os.getenv("CATCHUP_MAX_SEC") or "60").strip() or "60")
 ADMIN_DM_COOLDOWN_SEC = int((os.getenv("ADMIN_DM_COOLDOWN_SEC") or "60").strip() or "60")
+ERROR_REPORT_WINDOW_SEC = float((os.getenv("ERROR_REPORT_WINDOW_SEC") or "300").strip() or "300")  # одна сводка на ошибку за окно
 PROMO_WINDOW_HOURS = int((os.getenv("PROMO_WINDOW_HOURS") or "72").strip() or "72")
 PROMO_REMINDER_EVERY_HOURS = int((os.getenv("PROMO_REMINDER_EVERY_HOURS") or "10").strip() or "10")
-REMINDER_LOOP_INTERVAL_SEC = int((os.getenv("REMINDER_LOOP_INTERVAL_SEC") or "600").strip() or "600")  # как часто опрашивать очередь (в сек)
+REMINDER_LOOP_INTERVAL_SEC = int((os.getenv("REMINDER_LOOP_INTERVAL_SEC") or "600").strip() or "600")  # задержка первого пинга и повтора после ошибки (в сек)
+LEADS_META_TTL_SEC = int((os.getenv("LEADS_META_TTL_SEC") or "900").strip() or "900")  # сколько живёт кэш get_chat лид-чата
+
+# исходящие рассылки (напоминания, broadcast): лимиты Telegram
+SEND_RATE_PER_SEC = float((os.getenv("SEND_RATE_PER_SEC") or "30").strip() or "30")           # глобально на бота
+SEND_RATE_PER_CHAT_SEC = float((os.getenv("SEND_RATE_PER_CHAT_SEC") or "1").strip() or "1")   # в один личный чат
+SEND_RATE_PER_GROUP_MIN = float((os.getenv("SEND_RATE_PER_GROUP_MIN") or "20").strip() or "20")  # в одну группу
+SEND_CONCURRENCY = int((os.getenv("SEND_CONCURRENCY") or "16").strip() or "16")
+SEND_MAX_RETRIES = int((os.getenv("SEND_MAX_RETRIES") or "3").strip() or "3")
+
+# локальные данные (SQLite): очередь лидов и пр.
+DATA_DIR = (os.getenv("DATA_DIR") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")).strip()
+DB_PATH = (os.getenv("DB_PATH") or os.path.join(DATA_DIR, "vimly.sqlite3")).strip()
+OUTBOX_WORKERS = int((os.getenv("OUTBOX_WORKERS") or "2").strip() or "2")
+OUTBOX_BACKOFF_BASE_SEC = float((os.getenv("OUTBOX_BACKOFF_BASE_SEC") or "2").strip() or "2")
+OUTBOX_BACKOFF_MAX_SEC = float((os.getenv("OUTBOX_BACKOFF_MAX_SEC") or "600").strip() or "600")
+OUTBOX_MAX_ATTEMPTS = int((os.getenv("OUTBOX_MAX_ATTEMPTS") or "12").strip() or "12")   # потом лид — в dead-letter
+WEBAPP_MAX_BODY = int((os.getenv("WEBAPP_MAX_BODY") or "131072").strip() or "131072")     # байт; поля квиза ≤ 20000+20000+500 символов
+WEBHOOK_MAX_BODY = int((os.getenv("WEBHOOK_MAX_BODY") or "524288").strip() or "524288")
+STATIC_RELOAD = (os.getenv("STATIC_RELOAD") or "0").strip().lower() in {"1", "true", "yes"}   # dev: перечитывать webapp/quiz при изменении
+SUBMIT_RATE_PER_MIN = float((os.getenv("SUBMIT_RATE_PER_MIN") or "6").strip() or "6")   # /webapp/submit: на IP и на пользователя
+SUBMIT_BURST = float((os.getenv("SUBMIT_BURST") or "3").strip() or "3")
+WEB_CONCURRENCY = max(1, int((os.getenv("WEB_CONCURRENCY") or "1").strip() or "1"))  # воркеров uvicorn (он читает ту же переменную)
+MULTI_WORKER = WEB_CONCURRENCY > 1
+STARTUP_CACHE_TTL_SEC = int((os.getenv("STARTUP_CACHE_TTL_SEC") or "21600").strip() or "21600")  # доверять прошлой проверке лид-чатов столько
+LEADER_LEASE_SEC = float((os.getenv("LEADER_LEASE_SEC") or "15").strip() or "15")  # лидер не продлил аренду — её забирает другой воркер
+RATE_LIMIT_BACKEND = (os.getenv("RATE_LIMIT_BACKEND") or ("sqlite" if MULTI_WORKER else "memory")).strip().lower()   # memory | sqlite (общий для воркеров)
+_trust_proxy = (os.getenv("TRUST_PROXY_HEADERS") or "0").strip().lower()
+# сколько своих прокси стоит перед приложением (Render — 1); 0 — X-Forwarded-For не читаем, его подделает любой клиент
+TRUST_PROXY_HEADERS = 1 if _trust_proxy in {"true", "yes"} else 0 if _trust_proxy in {"false", "no", ""} else int(_trust_proxy)
+WEBAPP_INITDATA_MAX_AGE_SEC = int((os.getenv("WEBAPP_INITDATA_MAX_AGE_SEC") or "86400").strip() or "86400")  # 0 — не проверять возраст
+LEAD_DEDUP_TTL_SEC = int((os.getenv("LEAD_DEDUP_TTL_SEC") or "900").strip() or "900")      # окно антидублей лидов
+LEAD_DEDUP_MAX = int((os.getenv("LEAD_DEDUP_MAX") or "10000").strip() or "10000")
+LEADS_DIGEST_WINDOW_SEC = float((os.getenv("LEADS_DIGEST_WINDOW_SEC") or "0").strip() or "0")  # >0 — склеивать лиды за окно в один пост
+OUTBOX_LEASE_SEC = int((os.getenv("OUTBOX_LEASE_SEC") or "120").strip() or "120")  # «зависший» sending снова берётся в работу
 
 # ---------- PRICING ----------
 PRICING = {
@@ -146,28 +214,568 @@ BRAND_TG = (os.getenv("BRAND_TG") or "@Vimly_bot").strip()
 BRAND_SITE = (os.getenv("BRAND_SITE") or "").strip()
 
 # ---------- LOG ----------
-logging.basicConfig(level=logging.INFO, format="%(asctime)s | %(levelname)s | %(name)s | %(message)s")
+LOG_FORMAT = (os.getenv("LOG_FORMAT") or "text").strip().lower()   # text | json
+LOG_LEVEL = (os.getenv("LOG_LEVEL") or "INFO").strip().upper()
+LOG_TEXT_FMT = "%(asctime)s | %(levelname)s | %(name)s | %(message)s"
+
+def _parse_sample(spec: str) -> dict[str, float]:
+    """'webhook_update=0.01,leads_ok=1' → {event: доля событий, которые пишем}."""
+    out = {}
+    for part in (spec or "").split(","):
+        name, _, rate = part.partition("=")
+        if name.strip() and rate.strip():
+            try: out[name.strip()] = min(1.0, max(0.0, float(rate)))
+            except ValueError: pass
+    return out
+
+LOG_SAMPLE = _parse_sample(os.getenv("LOG_SAMPLE") or "webhook_update=0.01")
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        out = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            out.update(fields)
+        if record.exc_info:
+            out["exc"] = self.formatException(record.exc_info)
+        return json.dumps(out, ensure_ascii=False, default=str)
+
+class TextFormatter(logging.Formatter):
+    """Привычный текстовый формат + поля события как key=value."""
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        fields = getattr(record, "fields", None)
+        if fields:
+            line += " | " + " ".join(f"{k}={v}" for k, v in fields.items())
+        return line
+
+class _LazyQueueHandler(logging.handlers.QueueHandler):
+    """Форматирование и запись — в потоке QueueListener, а не в event loop.
+    Записи log_event (готовая строка, свежий dict полей) кладутся как есть; у остальных, включая
+    сторонние логгеры, сообщение подставляется сразу — аргументы могут поменяться до записи."""
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if getattr(record, "fields", None) is not None and not record.args:
+            return record
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+def setup_logging() -> logging.handlers.QueueListener:
+    q: queue.SimpleQueue = queue.SimpleQueue()
+    stream = logging.StreamHandler()
+    stream.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else TextFormatter(LOG_TEXT_FMT))
+    listener = logging.handlers.QueueListener(q, stream)
+    root = logging.getLogger()
+    root.handlers[:] = [_LazyQueueHandler(q)]
+    root.setLevel(LOG_LEVEL)
+    listener.start()
+    started = [True]
+
+    def _stop() -> None:   # дописать хвост очереди на выходе (один раз)
+        if started[0]:
+            started[0] = False
+            listener.stop()
+    atexit.register(_stop)
+    return listener
+
+log_listener = setup_logging()
 log = logging.getLogger("vimly-webapp")
+
+def log_event(event: str, level: int = logging.INFO, msg: str = "", **fields) -> None:
+    """Структурное событие горячего пути. Доля записей — из LOG_SAMPLE (по умолчанию все)."""
+    rate = LOG_SAMPLE.get(event, 1.0)
+    if rate < 1.0 and random.random() >= rate:
+        return
+    if not log.isEnabledFor(level):
+        return
+    fields["event"] = event
+    if rate < 1.0:
+        fields["sample_rate"] = rate
+    log.log(level, msg or event, extra={"fields": fields})
+
 log.info("Leads target (raw): %r  thread: %s", LEADS_RAW, LEADS_THREAD_ID or "—")
 
+# ---------- METRICS ----------
+METRICS_TOKEN = (os.getenv("METRICS_TOKEN") or "").strip()   # если задан — /metrics только с Bearer-токеном
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _esc_label(v) -> str:
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{n}="{_esc_label(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class Counter:
+    def __init__(self, name: str, help_: str, labels: tuple = ()):
+        self.name, self.help, self.label_names = name, help_, labels
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, *labels, n: float = 1) -> None:
+        self.values[labels] = self.values.get(labels, 0) + n
+
+    def render(self) -> list[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        out += [f"{self.name}{_labels(self.label_names, k)} {v}" for k, v in self.values.items()]
+        return out
+
+class Histogram:
+    def __init__(self, name: str, help_: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name, self.help, self.label_names, self.buckets = name, help_, labels, buckets
+        self.series: dict[tuple, list] = {}   # labels -> [counts по бакетам..., sum, count]
+
+    def observe(self, value: float, *labels) -> None:
+        st = self.series.get(labels)
+        if st is None:
+            st = self.series[labels] = [0] * len(self.buckets) + [0.0, 0]
+        for i, b in enumerate(self.buckets):
+            if value <= b:
+                st[i] += 1
+        st[-2] += value
+        st[-1] += 1
+
+    def render(self) -> list[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for k, st in self.series.items():
+            for i, b in enumerate(self.buckets):
+                le = 'le="%s"' % b
+                out.append(f"{self.name}_bucket{_labels(self.label_names, k, le)} {st[i]}")
+            le = 'le="+Inf"'
+            out.append(f"{self.name}_bucket{_labels(self.label_names, k, le)} {st[-1]}")
+            out.append(f"{self.name}_sum{_labels(self.label_names, k)} {st[-2]:.6f}")
+            out.append(f"{self.name}_count{_labels(self.label_names, k)} {st[-1]}")
+        return out
+
+class Metrics:
+    """Минимальный реестр в формате Prometheus text exposition (без внешних зависимостей)."""
+    handler_seconds = Histogram("vimly_handler_seconds", "Latency of bot/HTTP handlers", ("kind", "handler"))
+    handler_errors = Counter("vimly_handler_errors_total", "Handler exceptions", ("kind", "handler"))
+    http_requests = Counter("vimly_http_requests_total", "HTTP requests", ("handler", "status"))
+    tg_api_seconds = Histogram("vimly_telegram_api_seconds", "Telegram Bot API call latency", ("method",))
+    tg_api_calls = Counter("vimly_telegram_api_calls_total", "Telegram Bot API calls", ("method", "result"))
+    reminder_lag = Histogram("vimly_reminder_lag_seconds", "Delay between scheduled and actual promo reminder",
+                             buckets=(0.1, 0.5, 1.0, 5.0, 15.0, 60.0, 300.0, 900.0))
+    gauges: dict[str, tuple[str, object]] = {}   # name -> (help, callable)
+
+    @classmethod
+    def gauge(cls, name: str, help_: str, fn) -> None:
+        cls.gauges[name] = (help_, fn)
+
+    @classmethod
+    def render(cls) -> str:
+        lines = []
+        for m in (cls.handler_seconds, cls.handler_errors, cls.http_requests,
+                  cls.tg_api_seconds, cls.tg_api_calls, cls.reminder_lag):
+            lines += m.render()
+        for name, (help_, fn) in cls.gauges.items():
+            try:
+                value = fn()
+            except Exception as e:
+                log.debug("gauge %s failed: %s", name, e)
+                continue
+            lines += [f"# HELP {name} {help_}", f"# TYPE {name} gauge"]
+            if isinstance(value, dict):
+                lines += [f'{name}{{name="{_esc_label(k)}"}} {v}' for k, v in value.items()]
+            else:
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+class HandlerTimingMiddleware(BaseMiddleware):
+    """aiogram inner-middleware: латентность и ошибки по имени хендлера (on_start, quiz_done, …)."""
+    def __init__(self, kind: str):
+        self.kind = kind
+
+    async def __call__(self, handler, event, data):
+        h = data.get("handler")
+        name = getattr(getattr(h, "callback", None), "__name__", "unknown")
+        t0 = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            Metrics.handler_errors.inc(self.kind, name)
+            raise
+        finally:
+            Metrics.handler_seconds.observe(time.perf_counter() - t0, self.kind, name)
+
+class TelegramApiMetrics(BaseRequestMiddleware):
+    """Сессионная middleware бота: число и латентность вызовов Bot API по методу."""
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        t0 = time.perf_counter()
+        result = "ok"
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            result = type(e).__name__
+            raise
+        finally:
+            Metrics.tg_api_seconds.observe(time.perf_counter() - t0, name)
+            Metrics.tg_api_calls.inc(name, result)
+
 # ---------- AIOGRAM ----------
-bot = Bot(BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-dp = Dispatcher()
+bot = Bot(BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML),
+          session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None)
+bot.session.middleware(TelegramApiMetrics())
 
 # ---------- STORE ----------
 class Store:
+    """Флаги процесса. Пользователи/промо/офферы/счётчики — в `db` (см. STATE)."""
     accepting = True
     started_at = datetime.now(timezone.utc)
-    users = set()
-    stats = {"starts": 0, "quiz": 0, "orders": 0, "webquiz": 0, "contact_msgs": 0}
-
-Store.promos = {}
-Store.gift_claimed = set()
-Store.last_admin_dm = {}   # {user_id: datetime_utc}
-Store.gift_offer = {}      # {user_id: {"start": dt, "expires": dt, "last_reminder": Optional[dt], "claimed": bool}}
-Store.promos_by_code = {}   # code -> user_id
+
 BOT_USERNAME = ""
 
+# ---------- STATE ----------
+STATE_BACKEND = (os.getenv("STATE_BACKEND") or "sqlite").strip().lower()  # sqlite | memory
+STATE_FLUSH_INTERVAL_SEC = float((os.getenv("STATE_FLUSH_INTERVAL_SEC") or "0.5").strip() or "0.5")
+STATE_FLUSH_MAX_BATCH = int((os.getenv("STATE_FLUSH_MAX_BATCH") or "500").strip() or "500")
+FSM_STORAGE = (os.getenv("FSM_STORAGE") or "sqlite").strip().lower()  # sqlite | memory — где живут Quiz/Order/AdminMsg
+FSM_TTL_SEC = int((os.getenv("FSM_TTL_SEC") or "86400").strip() or "86400")  # брошенный диалог забывается через столько
+STATS_KEYS = ("starts", "quiz", "orders", "webquiz", "contact_msgs")
+
+def open_db(path: str = "") -> sqlite3.Connection:
+    """Соединение с локальной SQLite в режиме WAL (общий файл для очереди лидов и состояния)."""
+    path = path or DB_PATH
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=10)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+def _ts(dt: Optional[datetime]) -> Optional[float]:
+    return dt.timestamp() if dt is not None else None
+
+def _dt(ts: Optional[float]) -> Optional[datetime]:
+    return datetime.fromtimestamp(ts, timezone.utc) if ts is not None else None
+
+def _promo_from_row(code: str, expires_at: float, used: int) -> dict:
+    exp = _dt(expires_at)
+    return {"code": code, "expires_utc": exp.strftime("%Y-%m-%d %H:%M UTC"), "expires_dt": exp, "used": bool(used)}
+
+def _offer_is_open(offer: dict, now: datetime) -> bool:
+    return not offer.get("claimed") and now < offer["expires"]
+
+class MemoryState:
+    """Всё в памяти процесса: для тестов и локального запуска."""
+    def __init__(self):
+        self.users: set = set()
+        self.counters: dict = {k: 0 for k in STATS_KEYS}
+        self.promos: dict = {}          # user_id -> promo
+        self.promos_by_code: dict = {}  # code -> user_id
+        self.offers: dict = {}          # user_id -> {"start", "expires", "last_reminder", "claimed"}
+        self.admin_dm: dict = {}        # user_id -> datetime_utc
+        self.gift_claimed: set = set()
+        self.blocked: set = set()       # user_id, заблокировавшие бота
+        self.meta: dict = {}            # служебные key -> value (file_id и т.п.)
+
+    async def start(self): pass
+    async def close(self): pass
+
+    def add_user(self, user_id: int) -> None: self.users.add(user_id)
+    def users_count(self) -> int: return len(self.users)
+    def user_ids(self) -> list[int]: return list(self.users)
+    async def active_user_ids(self) -> list[int]: return list(self.users - self.blocked)
+
+    def incr(self, name: str, n: int = 1) -> None: self.counters[name] = self.counters.get(name, 0) + n
+    def stats(self) -> dict: return dict(self.counters)
+
+    def get_promo(self, user_id: int) -> Optional[dict]: return self.promos.get(user_id)
+    def promo_owner(self, code: str) -> Optional[int]: return self.promos_by_code.get(code)
+    def put_promo(self, user_id: int, promo: dict) -> None:
+        self.promos[user_id] = promo
+        self.promos_by_code[promo["code"]] = user_id
+
+    def get_offer(self, user_id: int) -> Optional[dict]: return self.offers.get(user_id)
+    def put_offer(self, user_id: int, offer: dict) -> None: self.offers[user_id] = offer
+    def open_offers(self, now: datetime) -> list[tuple[int, dict]]:
+        return [(uid, o) for uid, o in self.offers.items() if _offer_is_open(o, now)]
+
+    def mark_gift_claimed(self, user_id: int) -> None: self.gift_claimed.add(user_id)
+
+    def get_admin_dm(self, user_id: int) -> Optional[datetime]: return self.admin_dm.get(user_id)
+    def set_admin_dm(self, user_id: int, at: datetime) -> None: self.admin_dm[user_id] = at
+
+    def is_blocked(self, user_id: int) -> bool: return user_id in self.blocked
+    def set_blocked(self, user_id: int, blocked: bool = True) -> None:
+        (self.blocked.add if blocked else self.blocked.discard)(user_id)
+
+    def get_meta(self, key: str) -> Optional[str]: return self.meta.get(key)
+    def set_meta(self, key: str, value: Optional[str]) -> None:
+        if value is None: self.meta.pop(key, None)
+        else: self.meta[key] = value
+
+class SQLiteState:
+    """SQLite (WAL) с индексами по user_id/коду/сроку оффера.
+    Запись — пачками: изменения копятся в оверлее и раз в STATE_FLUSH_INTERVAL_SEC
+    уходят одной транзакцией; чтение сначала смотрит в оверлей (свои записи видны сразу).
+    Чтение идёт через отдельное соединение без writer-lock: в WAL читатель не ждёт писателя,
+    так что сброс пачки в потоке не блокирует event loop."""
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, first_seen REAL NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL DEFAULT 0)",
+        "CREATE TABLE IF NOT EXISTS promos (user_id INTEGER PRIMARY KEY, code TEXT NOT NULL UNIQUE,"
+        " expires_at REAL NOT NULL, used INTEGER NOT NULL DEFAULT 0)",
+        "CREATE TABLE IF NOT EXISTS offers (user_id INTEGER PRIMARY KEY, start_at REAL NOT NULL,"
+        " expires_at REAL NOT NULL, last_reminder REAL, claimed INTEGER NOT NULL DEFAULT 0)",
+        "CREATE INDEX IF NOT EXISTS offers_open_by_expiry ON offers(claimed, expires_at)",
+        "CREATE TABLE IF NOT EXISTS admin_dm (user_id INTEGER PRIMARY KEY, last_at REAL NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS gift_claims (user_id INTEGER PRIMARY KEY, claimed_at REAL NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS blocked (user_id INTEGER PRIMARY KEY, blocked_at REAL NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)",
+    )
+
+    def __init__(self, path: str = ""):
+        self.db = open_db(path)
+        self.lock = threading.Lock()     # writer: _write в потоке держит его всю транзакцию
+        with self.lock:
+            for ddl in self.SCHEMA:
+                self.db.execute(ddl)
+        self.rdb = open_db(path)         # reader: снимок последнего COMMIT, inflight чистится только после него
+        self.rlock = threading.Lock()
+        self.pending = self._empty_batch()
+        self.inflight = self._empty_batch()
+        self._task: Optional[asyncio.Task] = None
+        self._kick: Optional[asyncio.Event] = None
+
+    @staticmethod
+    def _empty_batch() -> dict:
+        return {"users": set(), "incr": {}, "promos": {}, "offers": {}, "admin_dm": {}, "gift": set(), "blocked": {}, "meta": {}}
+
+    def _overlay(self, table: str, key):
+        """Незаписанное значение (pending → inflight) или None."""
+        for batch in (self.pending, self.inflight):
+            if key in batch[table]:
+                return batch[table][key]
+        return None
+
+    def _query(self, sql: str, args: tuple = ()) -> list:
+        with self.rlock:
+            return self.rdb.execute(sql, args).fetchall()
+
+    def _dirty(self) -> None:
+        n = sum(len(v) for v in self.pending.values())
+        if n >= STATE_FLUSH_MAX_BATCH and self._kick is not None:
+            self._kick.set()
+
+    # --- lifecycle ---
+    async def start(self):
+        if self._task is None:
+            self._kick = asyncio.Event()
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._kick.wait(), timeout=STATE_FLUSH_INTERVAL_SEC)
+            except asyncio.TimeoutError:
+                pass
+            self._kick.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                log.exception("STATE flush failed: %s", e)
+
+    async def flush(self) -> None:
+        if not any(self.pending.values()):
+            return
+        self.inflight, self.pending = self.pending, self._empty_batch()
+        try:
+            await asyncio.to_thread(self._write, self.inflight)
+        except Exception:
+            # вернём батч, чтобы не потерять изменения; свежие записи важнее старых
+            for k, v in self.inflight.items():
+                if isinstance(v, set):
+                    self.pending[k] |= v
+                elif k == "incr":
+                    for name, n in v.items():
+                        self.pending[k][name] = self.pending[k].get(name, 0) + n
+                else:
+                    self.pending[k] = {**v, **self.pending[k]}
+            raise
+        finally:
+            self.inflight = self._empty_batch()
+
+    def _write(self, b: dict) -> None:
+        now = time.time()
+        with self.lock:
+            db = self.db
+            db.execute("BEGIN")
+            try:
+                db.executemany("INSERT OR IGNORE INTO users(user_id, first_seen) VALUES (?, ?)",
+                               [(u, now) for u in b["users"]])
+                db.executemany("INSERT INTO stats(name, value) VALUES (?, ?)"
+                               " ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+                               list(b["incr"].items()))
+                db.executemany("INSERT OR REPLACE INTO promos(user_id, code, expires_at, used) VALUES (?, ?, ?, ?)",
+                               [(u, p["code"], _ts(p["expires_dt"]), int(bool(p.get("used"))))
+                                for u, p in b["promos"].items()])
+                db.executemany("INSERT OR REPLACE INTO offers(user_id, start_at, expires_at, last_reminder, claimed)"
+                               " VALUES (?, ?, ?, ?, ?)",
+                               [(u, _ts(o["start"]), _ts(o["expires"]), _ts(o.get("last_reminder")),
+                                 int(bool(o.get("claimed")))) for u, o in b["offers"].items()])
+                db.executemany("INSERT OR REPLACE INTO admin_dm(user_id, last_at) VALUES (?, ?)",
+                               [(u, _ts(at)) for u, at in b["admin_dm"].items()])
+                db.executemany("INSERT OR IGNORE INTO gift_claims(user_id, claimed_at) VALUES (?, ?)",
+                               [(u, now) for u in b["gift"]])
+                db.executemany("INSERT OR REPLACE INTO blocked(user_id, blocked_at) VALUES (?, ?)",
+                               [(u, now) for u, on in b["blocked"].items() if on])
+                db.executemany("DELETE FROM blocked WHERE user_id = ?",
+                               [(u,) for u, on in b["blocked"].items() if not on])
+                db.executemany("INSERT OR REPLACE INTO meta(key, value) VALUES (?, ?)",
+                               [(k, v) for k, v in b["meta"].items() if v is not None])
+                db.executemany("DELETE FROM meta WHERE key = ?",
+                               [(k,) for k, v in b["meta"].items() if v is None])
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+
+    # --- users / stats ---
+    def add_user(self, user_id: int) -> None:
+        self.pending["users"].add(user_id); self._dirty()
+
+    def users_count(self) -> int:
+        unsaved = self.pending["users"] | self.inflight["users"]
+        n = self._query("SELECT COUNT(*) FROM users")[0][0]
+        if unsaved:
+            marks = ",".join("?" * len(unsaved))
+            n += len(unsaved) - self._query(f"SELECT COUNT(*) FROM users WHERE user_id IN ({marks})", tuple(unsaved))[0][0]
+        return n
+
+    def user_ids(self) -> list[int]:
+        ids = {r[0] for r in self._query("SELECT user_id FROM users")}
+        return list(ids | self.pending["users"] | self.inflight["users"])
+
+    async def active_user_ids(self) -> list[int]:
+        """Пользователи без заблокировавших бота: один запрос в потоке, оверлей — уже на event loop."""
+        rows = await asyncio.to_thread(
+            self._query, "SELECT user_id FROM users WHERE user_id NOT IN (SELECT user_id FROM blocked)")
+        ids = {r[0] for r in rows} | self.pending["users"] | self.inflight["users"]
+        for batch in (self.inflight, self.pending):     # незаписанные блокировки/разблокировки, свежие — последними
+            for u, on in batch["blocked"].items():
+                (ids.discard if on else ids.add)(u)
+        return list(ids)
+
+    def incr(self, name: str, n: int = 1) -> None:
+        self.pending["incr"][name] = self.pending["incr"].get(name, 0) + n; self._dirty()
+
+    def stats(self) -> dict:
+        out = {k: 0 for k in STATS_KEYS}
+        out.update(dict(self._query("SELECT name, value FROM stats")))
+        for batch in (self.inflight, self.pending):
+            for name, n in batch["incr"].items():
+                out[name] = out.get(name, 0) + n
+        return out
+
+    # --- promos ---
+    def get_promo(self, user_id: int) -> Optional[dict]:
+        p = self._overlay("promos", user_id)
+        if p is not None:
+            return p
+        rows = self._query("SELECT code, expires_at, used FROM promos WHERE user_id = ?", (user_id,))
+        return _promo_from_row(*rows[0]) if rows else None
+
+    def promo_owner(self, code: str) -> Optional[int]:
+        for batch in (self.pending, self.inflight):
+            for uid, p in batch["promos"].items():
+                if p["code"] == code:
+                    return uid
+        rows = self._query("SELECT user_id FROM promos WHERE code = ?", (code,))
+        return rows[0][0] if rows else None
+
+    def put_promo(self, user_id: int, promo: dict) -> None:
+        self.pending["promos"][user_id] = promo; self._dirty()
+
+    # --- gift offers ---
+    def get_offer(self, user_id: int) -> Optional[dict]:
+        o = self._overlay("offers", user_id)
+        if o is not None:
+            return o
+        rows = self._query("SELECT start_at, expires_at, last_reminder, claimed FROM offers WHERE user_id = ?", (user_id,))
+        if not rows:
+            return None
+        start, exp, last, claimed = rows[0]
+        return {"start": _dt(start), "expires": _dt(exp), "last_reminder": _dt(last), "claimed": bool(claimed)}
+
+    def put_offer(self, user_id: int, offer: dict) -> None:
+        self.pending["offers"][user_id] = offer; self._dirty()
+
+    def open_offers(self, now: datetime) -> list[tuple[int, dict]]:
+        # индекс (claimed, expires_at) отсекает забранные и истёкшие без полного скана
+        rows = self._query(
+            "SELECT user_id, start_at, expires_at, last_reminder FROM offers WHERE claimed = 0 AND expires_at > ?",
+            (_ts(now),),
+        )
+        out = {uid: {"start": _dt(st), "expires": _dt(exp), "last_reminder": _dt(last), "claimed": False}
+               for uid, st, exp, last in rows}
+        for batch in (self.inflight, self.pending):
+            for uid, o in batch["offers"].items():
+                if _offer_is_open(o, now):
+                    out[uid] = o
+                else:
+                    out.pop(uid, None)
+        return list(out.items())
+
+    # --- misc ---
+    def mark_gift_claimed(self, user_id: int) -> None:
+        self.pending["gift"].add(user_id); self._dirty()
+
+    def get_admin_dm(self, user_id: int) -> Optional[datetime]:
+        at = self._overlay("admin_dm", user_id)
+        if at is not None:
+            return at
+        rows = self._query("SELECT last_at FROM admin_dm WHERE user_id = ?", (user_id,))
+        return _dt(rows[0][0]) if rows else None
+
+    def set_admin_dm(self, user_id: int, at: datetime) -> None:
+        self.pending["admin_dm"][user_id] = at; self._dirty()
+
+    def is_blocked(self, user_id: int) -> bool:
+        on = self._overlay("blocked", user_id)
+        if on is not None:
+            return on
+        return bool(self._query("SELECT 1 FROM blocked WHERE user_id = ?", (user_id,)))
+
+    def set_blocked(self, user_id: int, blocked: bool = True) -> None:
+        self.pending["blocked"][user_id] = blocked; self._dirty()
+
+    def get_meta(self, key: str) -> Optional[str]:
+        for batch in (self.pending, self.inflight):
+            if key in batch["meta"]:
+                return batch["meta"][key]    # None — удалено, но ещё не записано
+        rows = self._query("SELECT value FROM meta WHERE key = ?", (key,))
+        return rows[0][0] if rows else None
+
+    def set_meta(self, key: str, value: Optional[str]) -> None:
+        """value=None — удалить ключ."""
+        self.pending["meta"][key] = value; self._dirty()
+
+def make_state_backend():
+    if STATE_BACKEND == "memory" and MULTI_WORKER:
+        raise RuntimeError("STATE_BACKEND=memory cannot be shared between workers; use sqlite with WEB_CONCURRENCY > 1")
+    if STATE_BACKEND == "memory":
+        return MemoryState()
+    if STATE_BACKEND == "sqlite":
+        return SQLiteState()
+    raise RuntimeError(f"Unknown STATE_BACKEND {STATE_BACKEND!r} (sqlite | memory)")
+
+db = make_state_backend()
+
 # ---------- FSM ----------
 class Quiz(StatesGroup):
     niche = State()
@@ -180,6 +788,163 @@ class Order(StatesGroup):
 class AdminMsg(StatesGroup):
     text = State()
 
+class SQLiteFSMStorage(BaseStorage):
+    """FSM-хранилище aiogram поверх той же SQLite: незаконченные квизы/заказы переживают редеплой.
+    Запись — пачками, как в SQLiteState (оверлей pending → inflight, сброс раз в STATE_FLUSH_INTERVAL_SEC);
+    в памяти только несброшенные изменения. Диалоги без активности дольше FSM_TTL_SEC
+    не читаются и вычищаются фоном. При нескольких воркерах шаг пишется сразу: следующий
+    ответ пользователя может прийти в другой процесс."""
+    SWEEP_EVERY_SEC = 600
+
+    def __init__(self, path: str = "", ttl: int = FSM_TTL_SEC, write_through: bool = MULTI_WORKER):
+        self.ttl = ttl
+        self.write_through = write_through
+        self.db = open_db(path)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.db.execute("CREATE TABLE IF NOT EXISTS fsm (key TEXT PRIMARY KEY, state TEXT,"
+                            " data TEXT NOT NULL DEFAULT '{}', updated_at REAL NOT NULL)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS fsm_by_updated ON fsm(updated_at)")
+        self.pending: dict = {}    # key -> {"state"?: str|None, "data"?: dict, "at": float}
+        self.inflight: dict = {}
+        self._task: Optional[asyncio.Task] = None
+        self._kick: Optional[asyncio.Event] = None
+        self._swept_at = 0.0
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return ":".join(str(p) for p in (key.bot_id, key.chat_id, key.user_id, key.thread_id or "",
+                                          key.business_connection_id or "", key.destiny))
+
+    def _overlay(self, k: str, field: str):
+        """(True, значение) из несброшенных изменений или (False, None)."""
+        now = time.time()
+        for batch in (self.pending, self.inflight):
+            e = batch.get(k)
+            if e is not None and field in e:
+                return True, (e[field] if now - e["at"] < self.ttl else None)
+        return False, None
+
+    async def _put(self, k: str, field: str, value) -> None:
+        if self.write_through:
+            await asyncio.to_thread(self._write, {k: {field: value, "at": time.time()}})
+            return
+        e = self.pending.setdefault(k, {})
+        e[field] = value
+        e["at"] = time.time()
+        if len(self.pending) >= STATE_FLUSH_MAX_BATCH and self._kick is not None:
+            self._kick.set()
+
+    def _row(self, k: str):
+        with self.lock:
+            return self.db.execute("SELECT state, data FROM fsm WHERE key = ? AND updated_at >= ?",
+                                   (k, time.time() - self.ttl)).fetchone()
+
+    # --- BaseStorage ---
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await self._put(self._key(key), "state", state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        k = self._key(key)
+        hit, state = self._overlay(k, "state")
+        if hit:
+            return state
+        row = self._row(k)
+        return row[0] if row else None
+
+    async def set_data(self, key: StorageKey, data) -> None:
+        await self._put(self._key(key), "data", dict(data))
+
+    async def get_data(self, key: StorageKey) -> dict:
+        k = self._key(key)
+        hit, data = self._overlay(k, "data")
+        if hit:
+            return dict(data or {})
+        row = self._row(k)
+        return json.loads(row[1]) if row else {}
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    # --- write-behind ---
+    async def start(self) -> None:
+        if self._task is None:
+            self._kick = asyncio.Event()
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._kick.wait(), timeout=STATE_FLUSH_INTERVAL_SEC)
+            except asyncio.TimeoutError:
+                pass
+            self._kick.clear()
+            try:
+                await self.flush()
+                if time.time() - self._swept_at >= min(self.SWEEP_EVERY_SEC, self.ttl):
+                    n = await asyncio.to_thread(self._sweep)
+                    if n:
+                        log.info("FSM sweep: %s abandoned conversations removed", n)
+            except Exception as e:
+                log.exception("FSM flush failed: %s", e)
+
+    async def flush(self) -> None:
+        if not self.pending:
+            return
+        self.inflight, self.pending = self.pending, {}
+        try:
+            await asyncio.to_thread(self._write, self.inflight)
+        except Exception:
+            # вернём батч; свежие поля важнее старых
+            for k, e in self.inflight.items():
+                self.pending[k] = {**e, **self.pending.get(k, {})}
+            raise
+        finally:
+            self.inflight = {}
+
+    def _write(self, batch: dict) -> None:
+        with self.lock:
+            db = self.db
+            db.execute("BEGIN")
+            try:
+                db.executemany("INSERT OR IGNORE INTO fsm(key, state, data, updated_at) VALUES (?, NULL, '{}', ?)",
+                               [(k, e["at"]) for k, e in batch.items()])
+                db.executemany("UPDATE fsm SET state = ? WHERE key = ?",
+                               [(e["state"], k) for k, e in batch.items() if "state" in e])
+                db.executemany("UPDATE fsm SET data = ? WHERE key = ?",
+                               [(json.dumps(e["data"], ensure_ascii=False), k) for k, e in batch.items() if "data" in e])
+                db.executemany("UPDATE fsm SET updated_at = ? WHERE key = ?", [(e["at"], k) for k, e in batch.items()])
+                # state.clear() — строку не держим
+                db.executemany("DELETE FROM fsm WHERE key = ? AND state IS NULL AND data = '{}'",
+                               [(k,) for k in batch])
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+
+    def _sweep(self) -> int:
+        self._swept_at = time.time()
+        with self.lock:
+            return self.db.execute("DELETE FROM fsm WHERE updated_at < ?", (self._swept_at - self.ttl,)).rowcount
+
+def make_fsm_storage() -> BaseStorage:
+    if FSM_STORAGE == "memory" and MULTI_WORKER:
+        raise RuntimeError("FSM_STORAGE=memory cannot be shared between workers; use sqlite with WEB_CONCURRENCY > 1")
+    if FSM_STORAGE == "memory":
+        return MemoryStorage()
+    if FSM_STORAGE == "sqlite":
+        return SQLiteFSMStorage()
+    raise RuntimeError(f"Unknown FSM_STORAGE {FSM_STORAGE!r} (sqlite | memory)")
+
+fsm_storage = make_fsm_storage()
+dp = Dispatcher(storage=fsm_storage)
+dp.message.middleware(HandlerTimingMiddleware("message"))
+dp.callback_query.middleware(HandlerTimingMiddleware("callback"))
+
 # ---------- HELPERS ----------
 def now_utc() -> datetime:
     return datetime.now(timezone.utc)
@@ -198,17 +963,14 @@ def humanize_timedelta(td: timedelta) -> str:
     return " ".join(parts)
 
 def get_or_start_offer(user_id: int) -> dict:
-    offer_dict = getattr(Store, "gift_offer", None)
-    if offer_dict is None:
-        Store.gift_offer = {}
-        offer_dict = Store.gift_offer
-
-    offer = offer_dict.get(user_id)
+    offer = db.get_offer(user_id)
     if not offer:
         start = now_utc()
         expires = start + timedelta(hours=PROMO_WINDOW_HOURS)
         offer = {"start": start, "expires": expires, "last_reminder": None, "claimed": False}
-        offer_dict[user_id] = offer
+        db.put_offer(user_id, offer)
+        if Leader.is_leader:    # у остальных цикла напоминаний нет — лидер подберёт оффер из БД (adopt)
+            reminders.schedule(user_id, offer)
     return offer
 
 def is_offer_active(offer: dict) -> bool:
@@ -226,14 +988,40 @@ def gen_promo_for(user_id: int, expires_at: Optional[datetime] = None) -> dict:
         "expires_dt": expires_at,
         "used": False,
     }
-    Store.promos[user_id] = data
-    Store.promos_by_code[code] = user_id
+    db.put_promo(user_id, data)
     return data
 
+# --- кэш статичных текстов/клавиатур ---
+class RenderCache:
+    """Мемоизация меню/тарифов: результат зависит только от аргументов и от BASE_URL/BRAND_*/PRICING,
+    а они задаются при импорте и в рантайме не меняются — ключ кэша это только (build, args).
+    Готовые InlineKeyboardMarkup общие для всех апдейтов — не мутировать."""
+    _memo: dict = {}
+
+    @classmethod
+    def get(cls, build, *args):
+        key = (build, args)
+        v = cls._memo.get(key)
+        if v is None:
+            v = cls._memo[key] = build(*args)
+        return v
+
+    @classmethod
+    def warm(cls) -> None:
+        for private in (True, False):
+            for admin in (True, False):
+                main_kb(private, admin)
+        prices_root_text(); prices_root_kb(); header()
+        for key in PRICING:
+            pkg_text(key); pkg_kb(key)
+
 def _bullets_html(items: list[str]) -> str:
     return "\n".join(f"• {esc(x)}" for x in items)
 
 def prices_root_text() -> str:
+    return RenderCache.get(_build_prices_root_text)
+
+def _build_prices_root_text() -> str:
     return (
         "<b>Пакеты и цены</b>\n\n"
         "Выберите тариф, чтобы посмотреть состав и оформить заказ:\n\n"
@@ -246,6 +1034,9 @@ def prices_root_text() -> str:
     )
 
 def prices_root_kb() -> InlineKeyboardMarkup:
+    return RenderCache.get(_build_prices_root_kb)
+
+def _build_prices_root_kb() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="💡 Vimly Lite", callback_data="pkg_lite")],
         [InlineKeyboardButton(text="🚀 Vimly Start", callback_data="pkg_start")],
@@ -256,6 +1047,9 @@ def prices_root_kb() -> InlineKeyboardMarkup:
     ])
 
 def pkg_text(key: str) -> str:
+    return RenderCache.get(_build_pkg_text, key)
+
+def _build_pkg_text(key: str) -> str:
     p = PRICING[key]
     return (
         f"<b>{esc(p['title'])}</b>\n\n"
@@ -263,17 +1057,23 @@ def pkg_text(key: str) -> str:
         f"{_bullets_html(p['bullets'])}"
     )
 
-def pkg_kb() -> InlineKeyboardMarkup:
-    # две кнопки: назад и «оплатить/заказать»
+def pkg_kb(key: str) -> InlineKeyboardMarkup:
+    return RenderCache.get(_build_pkg_kb, key)
+
+def _build_pkg_kb(key: str) -> InlineKeyboardMarkup:
+    # две кнопки: назад и «оплатить/заказать» (тариф едет в callback — по нему маршрутизируется заказ)
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="⬅️ Назад к тарифам", callback_data="go_prices"),
-         InlineKeyboardButton(text="💳 Оплатить / Заказать", callback_data="go_order")],
+         InlineKeyboardButton(text="💳 Оплатить / Заказать", callback_data=f"go_order:{key}")],
     ])
 
 def esc(s: Optional[str]) -> str:
     return html.escape(s or "", quote=False)
 
 def header() -> str:
+    return RenderCache.get(_build_header)
+
+def _build_header() -> str:
     parts = [f"<b>{esc(BRAND_NAME)}</b>", esc(BRAND_TAGLINE)]
     if BRAND_SITE: parts.append(esc(BRAND_SITE))
     return "\n".join(parts)
@@ -283,6 +1083,12 @@ def ufmt(m: Message) -> str:
     tag = f"@{u.username}" if u.username else f"id={u.id}"
     return esc(f"{u.full_name} ({tag})")
 
+def ufmt_webapp(u: dict) -> str:
+    """То же, что ufmt, для user из проверенного initData (dict)."""
+    full_name = " ".join(x for x in (u.get("first_name"), u.get("last_name")) if x) or "—"
+    tag = f"@{u['username']}" if u.get("username") else f"id={u.get('id')}"
+    return esc(f"{full_name} ({tag})")
+
 def parse_leads_target(s: str):
     s = (s or "").strip()
     if not s: return None
@@ -290,61 +1096,255 @@ def parse_leads_target(s: str):
     try: return int(s)
     except ValueError: return None
 
-async def _send_to_leads(text: str) -> bool:
-    target = parse_leads_target(LEADS_RAW)
-    if not target:
-        log.error("LEADS_CHAT_ID invalid/empty: %r", LEADS_RAW)
-        return False
-    try:
-        # Проверим необходимость thread_id (если включены темы)
-        try:
-            chat = await bot.get_chat(target)
-            if getattr(chat, "is_forum", False) and not LEADS_THREAD_ID:
-                log.error("LEADS_THREAD_ID required: chat has topics enabled")
-                if ADMIN_CHAT_ID:
-                    try:
-                        await bot.send_message(
-                            ADMIN_CHAT_ID,
-                            "⚠️ В лид-чате включены темы — укажите корректный LEADS_THREAD_ID.",
-                            disable_notification=True,
-                        )
-                    except Exception:
-                        pass
-                return False
-        except Exception as e:
-            log.debug("get_chat failed for %r: %s", LEADS_RAW, e)
+# --- маршруты лидов: вид заявки (и тариф) → один или несколько лид-чатов ---
+class LeadTarget(NamedTuple):
+    chat: object        # int (-100…) или "@channel"
+    thread_id: int = 0  # 0 — без темы
+
+    def __str__(self) -> str:
+        return f"{self.chat}/{self.thread_id}" if self.thread_id else str(self.chat)
+
+LEAD_KINDS = ("webapp", "quiz", "order")
 
-        kwargs = {"disable_web_page_preview": True}
-        if LEADS_THREAD_ID:
-            kwargs["message_thread_id"] = LEADS_THREAD_ID
-        msg = await bot.send_message(target, text, **kwargs)
+def parse_lead_target(s: str) -> LeadTarget:
+    """"-100123", "-100123/45" (тема форума) или "@channel"."""
+    chat_s, _, thread_s = (s or "").strip().partition("/")
+    chat = parse_leads_target(chat_s)
+    if chat is None or (isinstance(chat, int) and chat >= 0):
+        raise ValueError(f"bad chat {chat_s.strip()!r}: use -100… or @channel")
+    try:
+        thread = int(thread_s) if thread_s.strip() else 0
+    except ValueError:
+        raise ValueError(f"bad thread id {thread_s.strip()!r}")
+    return LeadTarget(chat, thread)
+
+def parse_lead_routes(spec: str) -> dict:
+    """'default=-100111/7; webapp=-100222; order:pro=-100333,-100111/9' → {селектор: (LeadTarget, …)}.
+    Селектор — default, вид заявки (webapp | quiz | order) или вид:тариф; правило без «=» — это default.
+    Более поздние правила перекрывают ранние."""
+    routes: dict = {}
+    for rule in re.split(r"[;\n]+", spec or ""):
+        rule = rule.strip()
+        if not rule:
+            continue
+        sel, eq, targets = rule.partition("=")
+        if not eq:
+            sel, targets = "default", rule
+        sel = sel.strip().lower()
+        kind, _, pkg = sel.partition(":")
+        if sel != "default" and (kind not in LEAD_KINDS or (pkg and pkg not in PRICING)):
+            raise ValueError(f"unknown selector {sel!r}")
+        ts = tuple(dict.fromkeys(parse_lead_target(t) for t in targets.split(",") if t.strip()))
+        if not ts:
+            raise ValueError(f"no targets for {sel!r}")
+        routes[sel] = ts
+    if "default" not in routes:
+        raise ValueError("default route is required")
+    return routes
+
+def format_lead_routes(routes: dict) -> str:
+    return "; ".join(f"{sel}={','.join(str(t) for t in ts)}" for sel, ts in routes.items())
+
+class LeadRouter:
+    """Таблица маршрутов, разобранная один раз. /set_leads подменяет её целиком одной операцией
+    (отправка видит либо старую, либо новую таблицу) и сохраняет в meta — оттуда она
+    переживает рестарт и подхватывается другими воркерами."""
+    META_KEY = "leads_routes"
+    RELOAD_SEC = 5.0
+    routes: dict = {}
+    spec = ""
+    _checked_at = 0.0
+
+    @staticmethod
+    def env_spec() -> str:
+        base = f"{LEADS_RAW}/{LEADS_THREAD_ID}" if LEADS_THREAD_ID else LEADS_RAW
+        return f"default={base}; {LEADS_ROUTES}" if LEADS_ROUTES else f"default={base}"
+
+    @classmethod
+    def _swap(cls, spec: str) -> dict:
+        routes = parse_lead_routes(spec)
+        cls.routes, cls.spec = routes, spec
+        return routes
+
+    @classmethod
+    def load(cls) -> None:
+        """Последняя таблица из /set_leads, иначе из env. Битый env — ValueError."""
+        stored = db.get_meta(cls.META_KEY)
         try:
-            chat = await bot.get_chat(target)
-            log.info("LEADS OK → %s (%s), msg_id=%s", getattr(chat, "title", "—"), chat.id, msg.message_id)
-        except Exception:
-            log.info("LEADS OK → chat=%r, msg_id=%s", LEADS_RAW, getattr(msg, "message_id", "—"))
-        return True
-    except TelegramForbiddenError as e:
-        log.error("LEADS forbidden: %s (бот кикнут/нет прав)", e)
-        if ADMIN_CHAT_ID:
+            cls._swap(stored or cls.env_spec())
+        except ValueError as e:
+            if not stored:
+                raise
+            log.error("stored leads routes are invalid (%s), using env", e)
+            cls._swap(cls.env_spec())
+        cls._checked_at = time.monotonic()
+
+    @classmethod
+    def set(cls, spec: str) -> dict:
+        routes = cls._swap(format_lead_routes(parse_lead_routes(spec)))
+        db.set_meta(cls.META_KEY, cls.spec)
+        return routes
+
+    @classmethod
+    def set_default(cls, target: str) -> dict:
+        """Меняет только default, остальные правила остаются."""
+        routes = {**cls.routes, "default": (parse_lead_target(target),)}
+        return cls.set(format_lead_routes(routes))
+
+    @classmethod
+    def reset(cls) -> dict:
+        db.set_meta(cls.META_KEY, None)
+        return cls._swap(cls.env_spec())
+
+    @classmethod
+    def _maybe_reload(cls) -> None:
+        # другой воркер мог выполнить /set_leads
+        if not MULTI_WORKER or time.monotonic() - cls._checked_at < cls.RELOAD_SEC:
+            return
+        cls._checked_at = time.monotonic()
+        spec = db.get_meta(cls.META_KEY) or cls.env_spec()
+        if spec != cls.spec:
             try:
-                await bot.send_message(
-                    ADMIN_CHAT_ID,
-                    "⚠️ Бот не может писать в лид-чат (возможно, кикнут/нет прав). Проверьте, что бот в чате и LEADS_CHAT_ID корректен."
-                )
-            except Exception: pass
-        return False
-    except Exception as e:
-        log.warning("LEADS FAIL → %r | %s", LEADS_RAW, e)
-        if ADMIN_CHAT_ID:
+                cls._swap(spec)
+                log.info("leads routes reloaded: %s", spec)
+            except ValueError as e:
+                log.error("leads routes reload failed: %s", e)
+
+    @classmethod
+    def resolve(cls, route: str) -> tuple:
+        """route — "webapp", "quiz", "order" или "order:pro": точное правило → вид → default."""
+        cls._maybe_reload()
+        return cls.routes.get(route) or cls.routes.get(route.partition(":")[0]) or cls.routes["default"]
+
+    @classmethod
+    def targets(cls) -> list:
+        return list(dict.fromkeys(t for ts in cls.routes.values() for t in ts))
+
+try:
+    LeadRouter.load()
+except ValueError as e:
+    logging.critical("Invalid LEADS_ROUTES %r: %s", LEADS_ROUTES, e)
+    raise RuntimeError("Invalid LEADS_ROUTES env var")
+
+# --- кэш метаданных лид-чатов (get_chat) ---
+class LeadsChatCache:
+    """Результат get_chat по каждому лид-чату: заполняется на старте и в /check_leads, /set_leads.
+    Путь отправки лида его только читает — один API-вызов на лид."""
+    _chats: dict = {}          # chat -> (aiogram Chat, fetched_at)
+    _refreshing: dict = {}     # chat -> Task
+
+    @classmethod
+    def put(cls, target, chat) -> None:
+        cls._chats[target] = (chat, now_utc())
+
+    @classmethod
+    def invalidate(cls, target=None) -> None:
+        if target is None:
+            cls._chats.clear()
+        else:
+            cls._chats.pop(target, None)
+
+    @classmethod
+    def get(cls, target):
+        """Закэшированный chat для target (даже устаревший) или None."""
+        e = cls._chats.get(target)
+        return e[0] if e else None
+
+    @classmethod
+    def is_fresh(cls, target) -> bool:
+        e = cls._chats.get(target)
+        return e is not None and (now_utc() - e[1]).total_seconds() < LEADS_META_TTL_SEC
+
+    @classmethod
+    async def refresh(cls, target):
+        chat = await bot.get_chat(target)
+        cls.put(target, chat)
+        return chat
+
+    @classmethod
+    def refresh_in_background(cls, target) -> None:
+        """Обновляет кэш вне пути отправки; повторно не запускается, пока идёт прошлый запрос."""
+        task = cls._refreshing.get(target)
+        if task is not None and not task.done():
+            return
+        async def _run():
             try:
-                await bot.send_message(
-                    ADMIN_CHAT_ID,
-                    f"⚠️ LEADS FAIL → <code>{esc(str(e))}</code>\n(target={esc(str(LEADS_RAW))}, thread={LEADS_THREAD_ID or '—'})",
-                    disable_notification=True
-                )
-            except Exception: pass
-        return False
+                await cls.refresh(target)
+            except Exception as e:
+                log.debug("get_chat (bg) failed for %r: %s", target, e)
+        try:
+            cls._refreshing[target] = asyncio.get_running_loop().create_task(_run())
+        except RuntimeError:
+            pass
+
+class LeadsConfigError(Exception):
+    """Лид-чат настроен так, что отправить в него нельзя (нужна тема форума)."""
+
+async def _deliver_lead(text: str, target: LeadTarget) -> None:
+    """Одна отправка в один лид-чат. Ошибки пробрасывает — ими распоряжается вызывающий."""
+    # Проверим необходимость thread_id (если включены темы) — по кэшу, без лишнего get_chat
+    chat = LeadsChatCache.get(target.chat)
+    if not LeadsChatCache.is_fresh(target.chat):
+        LeadsChatCache.refresh_in_background(target.chat)
+    if chat is not None and getattr(chat, "is_forum", False) and not target.thread_id:
+        raise LeadsConfigError(f"thread id required: {target} has topics enabled")
+
+    kwargs = {"disable_web_page_preview": True}
+    if target.thread_id:
+        kwargs["message_thread_id"] = target.thread_id
+    try:
+        msg = await bot.send_message(target.chat, text, **kwargs)
+    except (TelegramForbiddenError, TelegramBadRequest):
+        LeadsChatCache.invalidate(target.chat)   # чат мог смениться/включить темы/выгнать бота — перечитаем
+        raise
+    log_event("leads_ok", chat=getattr(chat, "id", target.chat), thread=target.thread_id or None,
+              title=getattr(chat, "title", None), msg_id=getattr(msg, "message_id", None))
+
+async def _deliver_route(text: str, route: str, skip: frozenset = frozenset()) -> tuple[list, list]:
+    """Шлёт лид во все чаты маршрута параллельно (кроме уже получивших — skip).
+    Возвращает (куда доставлено, [(target, ошибка)])."""
+    targets = [t for t in LeadRouter.resolve(route) if str(t) not in skip]
+    results = await asyncio.gather(*(_deliver_lead(text, t) for t in targets), return_exceptions=True)
+    done, errors = [], []
+    for t, r in zip(targets, results):
+        if isinstance(r, Exception):
+            errors.append((t, r))
+        elif isinstance(r, BaseException):
+            raise r
+        else:
+            done.append(str(t))
+    return done, errors
+
+async def _report_leads_failure(e: Exception, target: Optional[LeadTarget] = None) -> None:
+    """Лог + тихое уведомление админа о том, почему лид не ушёл."""
+    where = esc(str(target)) if target is not None else "—"
+    if isinstance(e, LeadsConfigError):
+        log.error("%s", e)
+        admin_txt = f"⚠️ В лид-чате <code>{where}</code> включены темы — укажите тему: /set_leads -100…/ID"
+    elif isinstance(e, TelegramForbiddenError):
+        log.error("LEADS forbidden → %s: %s (бот кикнут/нет прав)", target, e)
+        admin_txt = (f"⚠️ Бот не может писать в лид-чат <code>{where}</code> (возможно, кикнут/нет прав). "
+                     "Проверьте, что бот в чате, и маршруты в /get_leads.")
+    else:
+        log.warning("LEADS FAIL → %s | %s", target, e)
+        admin_txt = f"⚠️ LEADS FAIL → <code>{esc(str(e))}</code>\n(target={where})"
+    if ADMIN_CHAT_ID:
+        try:
+            await bot.send_message(ADMIN_CHAT_ID, admin_txt, disable_notification=True)
+        except Exception: pass
+
+async def _send_to_leads(text: str) -> list[tuple[LeadTarget, Optional[Exception]]]:
+    """Синхронная (в рамках запроса) отправка во все лид-чаты маршрутов; ошибки — админу."""
+    targets = LeadRouter.targets()
+    results = await asyncio.gather(*(_deliver_lead(text, t) for t in targets), return_exceptions=True)
+    out = []
+    for t, r in zip(targets, results):
+        if isinstance(r, Exception):
+            await _report_leads_failure(r, t)
+            out.append((t, r))
+        else:
+            out.append((t, None))
+    return out
 
 async def notify_admin(text: str) -> bool:
     """Шлёт ТОЛЬКО админу в ЛС. Не дублирует в лид-чат."""
@@ -357,6 +1357,548 @@ async def notify_admin(text: str) -> bool:
             ok = False
     return ok
 
+_bg_tasks: set = set()   # сильные ссылки: иначе GC может прибить задачу на середине
+
+def _bg_done(task: asyncio.Task) -> None:
+    _bg_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        log.error("background task %s failed: %s", task.get_name(), task.exception(), exc_info=task.exception())
+
+def spawn(coro, name: Optional[str] = None) -> asyncio.Task:
+    """Фоновая задача «запустил и забыл», но с удержанием ссылки и логом исключения."""
+    task = asyncio.create_task(coro, name=name)
+    _bg_tasks.add(task)
+    task.add_done_callback(_bg_done)
+    return task
+
+# ---------- OUTBOX (очередь лидов) ----------
+class Outbox:
+    """Надёжная очередь лидов: запись в SQLite, доставка фоновыми воркерами с ретраями.
+    Ставящий в очередь не ждёт Telegram; пока лид-чат лежит, лиды копятся на диске."""
+    _db: Optional[sqlite3.Connection] = None
+    _lock = threading.Lock()
+    _wakeup: Optional[asyncio.Event] = None
+    _workers: list = []
+    _failing: set = set()  # лид-чаты (str(LeadTarget)) с текущей серией неудач — админа уже предупредили
+    _last_ok: dict = {}    # лид-чат -> monotonic последней доставки
+    HEALTHY_SEC = 60       # чат принимал лиды за это время — сбой, скорее всего, в самом лиде, а не в чате
+    sent = 0
+    failed_attempts = 0
+    dead = 0               # лидов ушло в dead-letter с момента старта
+
+    @classmethod
+    def open(cls) -> None:
+        if cls._db is not None:
+            return
+        conn = open_db()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS leads_outbox ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " text TEXT NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " next_at REAL NOT NULL,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " claimed_at REAL,"
+            " last_error TEXT,"
+            " route TEXT NOT NULL DEFAULT 'default',"  # селектор LeadRouter; чаты берутся в момент отправки
+            " sent_to TEXT NOT NULL DEFAULT '',"       # куда из маршрута уже доставлено (при частичном сбое)
+            " dead_at REAL)"                           # dead-letter: OUTBOX_MAX_ATTEMPTS неудач, больше не пробуем
+        )
+        cols = {r[1] for r in conn.execute("PRAGMA table_info(leads_outbox)")}
+        if "route" not in cols:   # база от прошлой версии
+            conn.execute("ALTER TABLE leads_outbox ADD COLUMN route TEXT NOT NULL DEFAULT 'default'")
+            conn.execute("ALTER TABLE leads_outbox ADD COLUMN sent_to TEXT NOT NULL DEFAULT ''")
+        if "dead_at" not in cols:
+            conn.execute("ALTER TABLE leads_outbox ADD COLUMN dead_at REAL")
+        conn.execute("CREATE INDEX IF NOT EXISTS leads_outbox_next ON leads_outbox(next_at)")
+        cls._db = conn
+
+    @classmethod
+    def _exec(cls, sql: str, args: tuple = ()):
+        with cls._lock:
+            return cls._db.execute(sql, args)
+
+    # --- синхронные операции (выполняются в потоке) ---
+    @classmethod
+    def _insert(cls, text: str, route: str) -> int:
+        now = time.time()
+        return cls._exec("INSERT INTO leads_outbox(text, created_at, next_at, route) VALUES (?, ?, ?, ?)",
+                         (text, now, now, route)).lastrowid
+
+    DIGEST_SCAN = 50   # сколько готовых лидов смотрим за раз при сборке дайджеста
+
+    @classmethod
+    def _claim(cls) -> tuple[list[tuple[int, str, int, str, str]], Optional[float]]:
+        """Забирает пачку (id, text, attempts, route, sent_to). Без дайджеста — по одному лиду.
+        В режиме дайджеста склеиваются лиды одного маршрута; пачка уходит, когда старейшему лиду
+        исполнилось окно или следующий лид уже не влезает в MAX_TG; иначе ничего не помечается
+        (лиды свободны для других воркеров), а вторым значением — через сколько проверить снова.
+        Лид, уже однажды не доставленный в составе пачки, повторяется отдельно — один плохой лид
+        не держит остальных."""
+        now = time.time()
+        limit = cls.DIGEST_SCAN if LEADS_DIGEST_WINDOW_SEC > 0 else 1
+        with cls._lock:
+            # SELECT + UPDATE одной транзакцией с блокировкой на запись: при WEB_CONCURRENCY>1
+            # outbox-воркеры всех процессов читают одну таблицу, и без неё лид заберут (и отправят) дважды
+            cls._db.execute("BEGIN IMMEDIATE")
+            try:
+                batch, ripe_in = cls._claim_locked(now, limit)
+                cls._db.execute("COMMIT")
+            except Exception:
+                cls._db.execute("ROLLBACK")
+                raise
+        return batch, ripe_in
+
+    @classmethod
+    def _claim_locked(cls, now: float, limit: int) -> tuple[list[tuple[int, str, int, str, str]], Optional[float]]:
+        rows = cls._db.execute(
+            "SELECT id, text, attempts, created_at, route, sent_to FROM leads_outbox"
+            " WHERE next_at <= ? AND (claimed_at IS NULL OR claimed_at < ?) AND dead_at IS NULL"
+            " ORDER BY next_at, id LIMIT ?",
+            (now, now - OUTBOX_LEASE_SEC, limit),
+        ).fetchall()
+        if not rows:
+            return [], None
+        if limit == 1 or rows[0][5] or rows[0][2]:
+            batch = rows[:1]     # частично доставленный или уже падавший лид добиваем отдельно
+        else:
+            rows = [r for r in rows if r[4] == rows[0][4] and not r[5] and not r[2]]
+            n = digest_fit([r[1] for r in rows])
+            batch = rows[:n]
+            full = n < len(rows) or len(rows) == limit
+            ripe_at = min(r[3] for r in batch) + LEADS_DIGEST_WINDOW_SEC
+            if not full and ripe_at > now:
+                return [], ripe_at - now
+        cls._db.executemany("UPDATE leads_outbox SET claimed_at = ? WHERE id = ?", [(now, r[0]) for r in batch])
+        return [(r[0], r[1], r[2], r[4], r[5]) for r in batch], None
+
+    @classmethod
+    def _done(cls, job_ids: list[int]) -> None:
+        with cls._lock:
+            cls._db.executemany("DELETE FROM leads_outbox WHERE id = ?", [(i,) for i in job_ids])
+
+    @classmethod
+    def _retry(cls, job_ids: list[int], delay: float, error: str, count_attempt: bool = True, sent_to: str = "") -> None:
+        with cls._lock:
+            cls._db.executemany(
+                "UPDATE leads_outbox SET next_at = ?, claimed_at = NULL, last_error = ?,"
+                " attempts = attempts + ?, sent_to = ? WHERE id = ?",
+                [(time.time() + delay, error[:500], 1 if count_attempt else 0, sent_to, i) for i in job_ids],
+            )
+
+    @classmethod
+    def _bury(cls, job_ids: list[int], error: str, sent_to: str = "") -> None:
+        with cls._lock:
+            cls._db.executemany(
+                "UPDATE leads_outbox SET dead_at = ?, claimed_at = NULL, last_error = ?,"
+                " attempts = attempts + 1, sent_to = ? WHERE id = ?",
+                [(time.time(), error[:500], sent_to, i) for i in job_ids],
+            )
+
+    @classmethod
+    def _next_due_in(cls) -> Optional[float]:
+        row = cls._exec("SELECT MIN(next_at) FROM leads_outbox WHERE claimed_at IS NULL AND dead_at IS NULL").fetchone()
+        return None if (row is None or row[0] is None) else max(0.0, row[0] - time.time())
+
+    @classmethod
+    def depth(cls) -> int:
+        if cls._db is None:
+            return 0
+        return cls._exec("SELECT COUNT(*) FROM leads_outbox WHERE dead_at IS NULL").fetchone()[0]
+
+    @classmethod
+    def dead_count(cls) -> int:
+        if cls._db is None:
+            return 0
+        return cls._exec("SELECT COUNT(*) FROM leads_outbox WHERE dead_at IS NOT NULL").fetchone()[0]
+
+    # --- async API ---
+    @classmethod
+    async def put(cls, text: str, route: str = "default") -> bool:
+        """Ставит лид в очередь. route — селектор LeadRouter ("webapp", "order:pro"…).
+        False — только если не удалось записать на диск."""
+        try:
+            cls.open()
+            await asyncio.to_thread(cls._insert, text, route)
+        except Exception as e:
+            log.error("OUTBOX put failed: %s", e)
+            return False
+        if cls._wakeup is not None:
+            cls._wakeup.set()
+        return True
+
+    @classmethod
+    def start(cls) -> None:
+        if cls._workers:
+            return
+        cls.open()
+        cls._wakeup = asyncio.Event()
+        cls._workers = [asyncio.create_task(cls._worker(i)) for i in range(max(1, OUTBOX_WORKERS))]
+        log.info("OUTBOX started: workers=%s, pending=%s", len(cls._workers), cls.depth())
+
+    @classmethod
+    async def stop(cls) -> None:
+        for t in cls._workers:
+            t.cancel()
+        await asyncio.gather(*cls._workers, return_exceptions=True)
+        cls._workers = []
+
+    @classmethod
+    def _backoff(cls, attempts: int) -> float:
+        return min(OUTBOX_BACKOFF_MAX_SEC, OUTBOX_BACKOFF_BASE_SEC * (2 ** min(attempts, 20)))
+
+    @classmethod
+    async def _recovered(cls, done: list) -> None:
+        now = time.monotonic()
+        for t in done:
+            cls._last_ok[t] = now
+            if t in cls._failing:
+                cls._failing.discard(t)
+                await notify_admin(f"✅ Лид-чат <code>{esc(t)}</code> снова доступен. В очереди: {cls.depth()}")
+
+    @classmethod
+    async def _dead_letter(cls, ids: list[int], tag: str, target, e: Exception, attempts: int, sent_to: str) -> None:
+        """Лид исчерпал OUTBOX_MAX_ATTEMPTS: больше не пробуем, админу — одно сообщение на лид."""
+        await asyncio.to_thread(cls._bury, ids, str(e), sent_to)
+        cls.dead += len(ids)
+        log.error("OUTBOX %s → %s dead after %s attempts: %s", tag, target, attempts, e)
+        await notify_admin(f"☠️ Лид {tag} не доставлен после {attempts} попыток → <code>{esc(str(target))}</code>:\n"
+                           f"<code>{esc(cut_text(str(e), 500))}</code>\n"
+                           "Повторов больше не будет; текст сохранён в leads_outbox (dead_at).")
+
+    @classmethod
+    async def _worker(cls, n: int) -> None:
+        while True:
+            try:
+                cls._wakeup.clear()
+                batch, ripe_in = await asyncio.to_thread(cls._claim)
+                if not batch:
+                    delay = ripe_in if ripe_in is not None else await asyncio.to_thread(cls._next_due_in)
+                    try:
+                        await asyncio.wait_for(cls._wakeup.wait(), timeout=delay if delay is not None else 60)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                ids = [r[0] for r in batch]
+                attempts = max(r[2] for r in batch)
+                route, sent_to = batch[0][3], batch[0][4]
+                skip = frozenset(x for x in sent_to.split(",") if x)
+                tag = f"#{ids[0]}" + (f"+{len(ids) - 1}" if len(ids) > 1 else "")
+                done, errors = await _deliver_route(digest_text([r[1] for r in batch]), route, skip)
+                await cls._recovered(done)
+                if errors:
+                    sent_to = ",".join(sorted(skip.union(done)))
+                    target, e = next(((t, err) for t, err in errors if not isinstance(err, TelegramRetryAfter)), errors[0])
+                    if isinstance(e, TelegramRetryAfter):
+                        # флуд-контроль — не ошибка лида, просто ждём сколько сказали
+                        wait = max(err.retry_after for _, err in errors)
+                        log.warning("OUTBOX %s → %s retry_after=%ss", tag, target, wait)
+                        await asyncio.to_thread(cls._retry, ids, float(wait), str(e), False, sent_to)
+                    else:
+                        cls.failed_attempts += 1
+                        now = time.monotonic()
+                        for t, err in errors:   # серия неудач — по каждому лид-чату отдельно, одно предупреждение на серию
+                            if isinstance(err, TelegramRetryAfter) or str(t) in cls._failing:
+                                continue
+                            if now - cls._last_ok.get(str(t), -cls.HEALTHY_SEC) >= cls.HEALTHY_SEC:
+                                cls._failing.add(str(t))
+                                await _report_leads_failure(err, t)
+                        if attempts + 1 >= OUTBOX_MAX_ATTEMPTS:
+                            await cls._dead_letter(ids, tag, target, e, attempts + 1, sent_to)
+                        else:
+                            delay = cls._backoff(attempts)
+                            log.warning("OUTBOX %s → %s attempt %s failed, retry in %.0fs: %s", tag, target, attempts + 1, delay, e)
+                            await asyncio.to_thread(cls._retry, ids, delay, str(e), True, sent_to)
+                else:
+                    cls.sent += len(ids)
+                    await asyncio.to_thread(cls._done, ids)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.exception("OUTBOX worker %s error: %s", n, e)
+                await asyncio.sleep(1)
+
+# ---------- SENDER (рассылки) ----------
+class TokenBucket:
+    """Токен-бакет с резервированием: acquire() сразу занимает токен и спит ровно столько,
+    сколько нужно, чтобы уложиться в rate — очередь ожидающих честная и без busy-loop."""
+    def __init__(self, rate: float, burst: float = 1.0):
+        self.rate = max(rate, 1e-6)
+        self.burst = max(burst, 1.0)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def reserve(self) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        return max(wait, self.paused_until - now)
+
+    def pause(self, seconds: float) -> None:
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self) -> None:
+        wait = self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+class OutboundDispatcher:
+    """Общий отправитель для напоминаний и рассылок: глобальный и per-chat лимит,
+    RetryAfter, пропуск заблокировавших бота, счётчики для админки."""
+    MAX_CHAT_BUCKETS = 10000
+
+    def __init__(self):
+        self.global_bucket = TokenBucket(SEND_RATE_PER_SEC, burst=SEND_RATE_PER_SEC)
+        self.chat_buckets: dict[int, TokenBucket] = {}
+        self.sem = asyncio.Semaphore(max(1, SEND_CONCURRENCY))
+        self.counters = {"sent": 0, "failed": 0, "blocked": 0, "skipped": 0, "retry_after": 0}
+        self._recent: list[float] = []   # monotonic-время последних отправок (для msg/s)
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        b = self.chat_buckets.get(chat_id)
+        if b is None:
+            if len(self.chat_buckets) >= self.MAX_CHAT_BUCKETS:
+                self.chat_buckets.clear()   # бакеты дешёвые, а в одном окне столько чатов не бывает
+            rate = SEND_RATE_PER_GROUP_MIN / 60 if chat_id < 0 else SEND_RATE_PER_CHAT_SEC
+            b = self.chat_buckets[chat_id] = TokenBucket(rate)
+        return b
+
+    def throughput(self, window: float = 60.0) -> float:
+        cutoff = time.monotonic() - window
+        self._recent = [t for t in self._recent if t >= cutoff]
+        return len(self._recent) / window
+
+    def stats(self) -> dict:
+        return {**self.counters, "per_sec": round(self.throughput(), 2)}
+
+    async def send(self, chat_id: int, text: str, **kwargs) -> bool:
+        """Одно сообщение с учётом лимитов. False — не доставлено (или чат заблокировал бота)."""
+        if chat_id > 0 and db.is_blocked(chat_id):
+            self.counters["skipped"] += 1
+            return False
+        async with self.sem:
+            for attempt in range(SEND_MAX_RETRIES + 1):
+                await self._chat_bucket(chat_id).acquire()
+                await self.global_bucket.acquire()
+                try:
+                    await bot.send_message(chat_id, text, **kwargs)
+                except TelegramRetryAfter as e:
+                    self.counters["retry_after"] += 1
+                    self.global_bucket.pause(e.retry_after)
+                    log.warning("SEND %s retry_after=%ss", chat_id, e.retry_after)
+                    continue
+                except TelegramForbiddenError as e:
+                    self.counters["blocked"] += 1
+                    if chat_id > 0:
+                        db.set_blocked(chat_id)
+                    log.info("SEND %s blocked: %s", chat_id, e)
+                    return False
+                except Exception as e:
+                    self.counters["failed"] += 1
+                    log.warning("SEND %s failed: %s", chat_id, e)
+                    return False
+                self.counters["sent"] += 1
+                self._recent.append(time.monotonic())
+                return True
+            self.counters["failed"] += 1
+            return False
+
+    async def broadcast(self, chat_ids, text: str, **kwargs) -> dict:
+        """Параллельная рассылка; возвращает сводку {total, ok, fail, sec}."""
+        t0 = time.monotonic()
+        ids = list(chat_ids)
+        results = await asyncio.gather(*(self.send(cid, text, **kwargs) for cid in ids))
+        ok = sum(1 for r in results if r)
+        return {"total": len(ids), "ok": ok, "fail": len(ids) - ok, "sec": round(time.monotonic() - t0, 1)}
+
+sender = OutboundDispatcher()
+
+# ---------- MEDIA (file_id кэш) ----------
+ASSETS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "assets")
+
+class MediaCache:
+    """Каждый файл грузим в Telegram один раз, дальше шлём по file_id (хранится в db.meta,
+    ключ — имя + хэш содержимого, так что изменённый файл перезальётся сам).
+    Если Telegram отверг file_id — забываем его и загружаем файл заново."""
+    _hashes: dict[str, tuple[float, int, str]] = {}   # path -> (mtime, size, sha1)
+    _locks: dict[str, asyncio.Lock] = {}
+
+    @classmethod
+    def _key(cls, path: str) -> str:
+        st = os.stat(path)
+        cached = cls._hashes.get(path)
+        if not cached or cached[:2] != (st.st_mtime, st.st_size):
+            with open(path, "rb") as f:
+                digest = hashlib.sha1(f.read()).hexdigest()[:16]
+            cached = cls._hashes[path] = (st.st_mtime, st.st_size, digest)
+        return f"file_id:{os.path.basename(path)}:{cached[2]}"
+
+    @staticmethod
+    def _file_id(msg: Message) -> Optional[str]:
+        if getattr(msg, "photo", None):
+            return msg.photo[-1].file_id
+        for attr in ("document", "video", "animation", "audio"):
+            obj = getattr(msg, attr, None)
+            if obj is not None:
+                return obj.file_id
+        return None
+
+    @classmethod
+    async def _send(cls, path: str, send):
+        """send(media) -> Message; media — file_id (str) или FSInputFile."""
+        key = cls._key(path)
+        fid = db.get_meta(key)
+        if fid:
+            try:
+                return await send(fid)
+            except TelegramBadRequest as e:
+                log.warning("cached file_id for %s rejected, re-uploading: %s", os.path.basename(path), e)
+                db.set_meta(key, None)
+        lock = cls._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            fid = db.get_meta(key)          # пока ждали, мог загрузить соседний запрос
+            if fid:
+                return await send(fid)
+            msg = await send(FSInputFile(path))
+            fid = cls._file_id(msg)
+            if fid:
+                db.set_meta(key, fid)
+                log.info("uploaded %s → file_id cached", os.path.basename(path))
+            return msg
+
+    @classmethod
+    async def answer_photo(cls, m: Message, path: str, **kwargs):
+        return await cls._send(path, lambda media: m.answer_photo(media, **kwargs))
+
+    @classmethod
+    async def answer_document(cls, m: Message, path: str, **kwargs):
+        return await cls._send(path, lambda media: m.answer_document(media, **kwargs))
+
+
+# ---------- ASSETS (производные картинки) ----------
+class StaticAsset(NamedTuple):
+    ctype: str
+    etag: str                 # без кавычек; для gzip/br — с суффиксом (strong ETag на каждое представление)
+    cache: str                # Cache-Control
+    variants: dict            # "identity" | "gzip" | "br" -> bytes
+
+
+def serve_asset(request: Request, a: Optional[StaticAsset]) -> Response:
+    """Ответ из памяти: лучшая кодировка из Accept-Encoding, ETag, 304 на If-None-Match."""
+    if a is None:
+        raise HTTPException(status_code=404)
+    accept = (request.headers.get("accept-encoding") or "").lower()
+    enc = next((e for e in ("br", "gzip") if e in a.variants and e in accept), "identity")
+    etag = f'"{a.etag}"' if enc == "identity" else f'"{a.etag}-{enc}"'
+    headers = {"ETag": etag, "Cache-Control": a.cache, "Vary": "Accept-Encoding"}
+    inm = request.headers.get("if-none-match")
+    if inm and (inm.strip() == "*" or etag in [t.strip().removeprefix("W/") for t in inm.split(",")]):
+        return Response(status_code=304, headers=headers)
+    if enc != "identity":
+        headers["Content-Encoding"] = enc
+    return Response(a.variants[enc], media_type=a.ctype, headers=headers)
+
+
+class AssetVariants:
+    """Из assets/hero.png на старте делаются фавиконы 32/64 px и облегчённый hero (JPEG для Telegram, WebP для веба).
+    Результат — в памяти и на диске (DATA_DIR/assets, имя с хэшем исходника): рестарт без правки картинки ничего не пересчитывает.
+    Без Pillow остаётся исходный hero.png."""
+    SRC = os.path.join(ASSETS_DIR, "hero.png")
+    CACHE_DIR = os.path.join(DATA_DIR, "assets")
+    PHOTO_SIDE = 1280                  # Telegram всё равно ужимает фото до 1280 по большей стороне
+    PHOTO_MAX_BYTES = 10 * 1024 * 1024  # лимит sendPhoto
+    CACHE = "public, max-age=604800"    # адреса без хэша (/favicon.ico), так что неделя + ETag, а не immutable
+    CTYPES = {".ico": "image/x-icon", ".png": "image/png", ".jpg": "image/jpeg", ".webp": "image/webp"}
+    _mem: dict = {}                    # имя ("favicon.ico", "hero.jpg", ...) -> StaticAsset
+    _paths: dict = {}                  # имя -> путь на диске
+    _src_hash = ""
+
+    @classmethod
+    def _square(cls, img, side: int):
+        w, h = img.size
+        c = min(w, h)
+        img = img.crop(((w - c) // 2, (h - c) // 2, (w - c) // 2 + c, (h - c) // 2 + c))
+        return img.resize((side, side), Image.LANCZOS)
+
+    @classmethod
+    def _render(cls, img, name: str) -> bytes:
+        buf = io.BytesIO()
+        if name == "favicon.ico":
+            cls._square(img, 64).save(buf, format="ICO", sizes=[(32, 32), (64, 64)])
+        elif name.startswith("favicon-"):
+            cls._square(img, int(name[8:-4])).save(buf, format="PNG", optimize=True)
+        else:
+            photo = img.convert("RGB")
+            photo.thumbnail((cls.PHOTO_SIDE, cls.PHOTO_SIDE), Image.LANCZOS)
+            opts = {"format": "JPEG", "optimize": True, "progressive": True} if name.endswith(".jpg") \
+                else {"format": "WEBP", "method": 6}
+            for quality in (85, 75, 65, 50):
+                buf = io.BytesIO()
+                photo.save(buf, quality=quality, **opts)
+                if buf.tell() <= cls.PHOTO_MAX_BYTES:
+                    break
+        return buf.getvalue()
+
+    @classmethod
+    def build(cls) -> None:
+        """Синхронно (на старте — в потоке): CPU + диск."""
+        try:
+            with open(cls.SRC, "rb") as f:
+                src = f.read()
+        except OSError:
+            return
+        h = hashlib.sha256(src).hexdigest()[:16]
+        if h == cls._src_hash:
+            return
+        os.makedirs(cls.CACHE_DIR, exist_ok=True)
+        mem, paths, img = {}, {}, None
+        t0 = time.perf_counter()
+        for name in ("favicon.ico", "favicon-32.png", "favicon-64.png", "hero.jpg", "hero.webp"):
+            stem, ext = os.path.splitext(name)
+            path = os.path.join(cls.CACHE_DIR, f"{stem}.{h}{ext}")
+            try:
+                with open(path, "rb") as f:
+                    body = f.read()
+            except OSError:
+                if Image is None:
+                    continue
+                try:
+                    if img is None:
+                        img = Image.open(cls.SRC)
+                        img.load()
+                    body = cls._render(img, name)
+                except Exception as e:
+                    log.warning("asset %s: %s", name, e)
+                    continue
+                tmp = f"{path}.{os.getpid()}.tmp"
+                with open(tmp, "wb") as f:
+                    f.write(body)
+                os.replace(tmp, path)   # несколько воркеров могут строить одновременно
+            mem[name] = StaticAsset(cls.CTYPES[ext], hashlib.sha256(body).hexdigest()[:16], cls.CACHE, {"identity": body})
+            paths[name] = path
+        for fn in os.listdir(cls.CACHE_DIR):    # варианты от прежней картинки больше не нужны
+            if h not in fn and not fn.endswith(".tmp"):
+                try:
+                    os.remove(os.path.join(cls.CACHE_DIR, fn))
+                except OSError:
+                    pass
+        cls._mem, cls._paths, cls._src_hash = mem, paths, h
+        log_event("assets_built", variants=len(mem), pillow=Image is not None,
+                  ms=round((time.perf_counter() - t0) * 1000, 1))
+
+    @classmethod
+    def get(cls, name: str) -> Optional[StaticAsset]:
+        return cls._mem.get(name)
+
+    @classmethod
+    def photo_path(cls) -> str:
+        """Что слать в Telegram как hero: облегчённый JPEG, пока его нет — исходник."""
+        return cls._paths.get("hero.jpg") or cls.SRC
+
 def is_admin(user_id: int) -> bool:
     return user_id == ADMIN_CHAT_ID and ADMIN_CHAT_ID != 0
 
@@ -372,27 +1914,15 @@ async def safe_edit(c: CallbackQuery, html_text: str, kb: Optional[InlineKeyboar
     except TelegramBadRequest:
         await m.answer(html_text, reply_markup=kb)
 
-def sanitize_phone(s: str) -> Optional[str]:
-    digits = re.sub(r"\D+", "", s or "")
-    return digits if 7 <= len(digits) <= 15 else None
-
-def gen_promo_for(user_id: int) -> dict:
-    suffix = secrets.token_hex(2).upper()
-    code = f"VIM-{str(user_id)[-4:]}-{suffix}"
-    expires = datetime.now(timezone.utc) + timedelta(hours=72)
-    data = {"code": code, "expires_utc": expires.strftime("%Y-%m-%d %H:%M UTC")}
-    Store.promos[user_id] = data
-    return data
-
 def admin_dm_left(user_id: int) -> int:
-    ts = Store.last_admin_dm.get(user_id)
+    ts = db.get_admin_dm(user_id)
     if not ts: return 0
     delta = (datetime.now(timezone.utc) - ts).total_seconds()
     left = int(ADMIN_DM_COOLDOWN_SEC - delta)
     return max(0, left)
 
 def admin_dm_mark(user_id: int):
-    Store.last_admin_dm[user_id] = datetime.now(timezone.utc)
+    db.set_admin_dm(user_id, datetime.now(timezone.utc))
 
 def deep_link(suffix: str) -> str:
     su = (suffix or "").strip().replace(" ", "_")
@@ -401,37 +1931,199 @@ def deep_link(suffix: str) -> str:
 def force_reply_if_needed(chat_type: str, placeholder: str) -> Optional[ForceReply]:
     return ForceReply(selective=True, input_field_placeholder=placeholder) if chat_type != "private" else None
 
-# --- строгая валидация квиза ---
-USERNAME_RE = re.compile(r"^@[a-zA-Z0-9_]{5,}$")
-EMAIL_RE    = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$")
+# --- контакт: один разбор на все пути лидов ---
+class Contact(NamedTuple):
+    kind: str    # username | email | phone
+    value: str   # нормализованный: @username и email — в нижнем регистре, телефон — +79991234567 (или цифры, если код страны неясен)
+    raw: str     # как ввёл пользователь — в лиде рядом с нормализованным
 
-def valid_contact(s: str) -> bool:
-    s = (s or "").strip()
-    if USERNAME_RE.match(s): return True
-    if EMAIL_RE.match(s): return True
-    d = re.sub(r"\D+", "", s)
-    return 7 <= len(d) <= 15
+    def label(self) -> str:
+        """Для текста лида: нормализованное значение и, если отличается, исходная запись."""
+        return self.value if self.raw == self.value else f"{self.value} (ввели: {cut_text(self.raw, 100)})"
+
+# username и email — одним проходом скомпилированной регулярки; телефон — одна вырезка цифр
+CONTACT_RE = re.compile(r"(?P<username>@[a-zA-Z0-9_]{5,})|(?P<email>[^@\s]+@[^@\s]+\.[^@\s]+)")
+NON_DIGITS_RE = re.compile(r"\D+")
 
-def validate_web_quiz(company: str, task: str, contact: str) -> tuple[bool, str]:
+def parse_contact(s: str, international: bool = False) -> Optional[Contact]:
+    """@username, email или телефон (7–15 цифр в любой записи); иначе None.
+    international=True — номер уже с кодом страны (contact.phone_number из Telegram, там он без «+»)."""
+    s = (s or "").strip()
+    if not s:
+        return None
+    m = CONTACT_RE.fullmatch(s)
+    if m is not None:
+        return Contact(m.lastgroup, s.lower(), s)
+    digits = NON_DIGITS_RE.sub("", s)
+    if not 7 <= len(digits) <= 15:
+        return None
+    if international or s.startswith("+"):
+        return Contact("phone", "+" + digits, s)       # код страны уже есть («+84…» не трогаем)
+    if len(digits) == 11 and digits[0] == "8":     # 8 999 … — российский формат с префиксом 8
+        return Contact("phone", "+7" + digits[1:], s)
+    if len(digits) == 10:                          # 999 123-45-67, (495) 123-45-67 — российский без кода
+        return Contact("phone", "+7" + digits, s)
+    if len(digits) < 10:                           # городской без кода — «+» не приписываем, номер неполный
+        return Contact("phone", digits, s)
+    return Contact("phone", "+" + digits, s)
+
+def validate_web_quiz(company: str, task: str, contact: str) -> tuple[Optional[Contact], str]:
+    """(контакт, "") если анкета годится, иначе (None, текст ошибки)."""
     company = (company or "").strip()
     task    = (task or "").strip()
     contact = (contact or "").strip()
     if not company or not task or not contact:
-        return False, "Заполните все поля: описание, задача и контакт."
+        return None, "Заполните все поля: описание, задача и контакт."
     if len(company) < 3:
-        return False, "Описание компании слишком короткое (мин. 3 символа)."
+        return None, "Описание компании слишком короткое (мин. 3 символа)."
     if len(task) < 5:
-        return False, "Задача слишком короткая (мин. 5 символов)."
-    if not valid_contact(contact):
-        return False, "Контакт укажи как @username, телефон или email."
-    return True, ""
+        return None, "Задача слишком короткая (мин. 5 символов)."
+    ct = parse_contact(contact)
+    if ct is None:
+        return None, "Контакт укажи как @username, телефон или email."
+    return ct, ""
+
+# --- проверка Telegram.WebApp.initData (HMAC-SHA256 от BOT_TOKEN) ---
+WEBAPP_SECRET_KEY = hmac.new(b"WebAppData", BOT_TOKEN.encode(), hashlib.sha256).digest()  # считаем один раз
+
+def verify_webapp_init_data(init_data: str) -> Optional[dict]:
+    """Возвращает user (dict) из подписанного initData или None, если подпись/срок не сходятся."""
+    if not init_data:
+        return None
+    try:
+        pairs = parse_qsl(init_data, keep_blank_values=True, strict_parsing=True)
+    except ValueError:
+        return None
+    fields = dict(pairs)
+    received = fields.pop("hash", "")
+    if not received:
+        return None
+    check = "\n".join(f"{k}={v}" for k, v in sorted(fields.items()))
+    expected = hmac.new(WEBAPP_SECRET_KEY, check.encode(), hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(expected, received):
+        return None
+    if WEBAPP_INITDATA_MAX_AGE_SEC:
+        try:
+            if time.time() - int(fields.get("auth_date", "0")) > WEBAPP_INITDATA_MAX_AGE_SEC:
+                return None
+        except ValueError:
+            return None
+    try:
+        user = json.loads(fields.get("user") or "null")
+    except ValueError:
+        return None
+    return user if isinstance(user, dict) and user.get("id") else None
+
+# --- антидубли WebApp-лидов: sendData и POST /webapp/submit несут один nonce ---
+class LeadDedup:
+    """Ограниченный LRU недавно принятых лидов с TTL. Ключ — nonce + хэш содержимого,
+    так что sendData и HTTP-бэкап одной отправки дают один лид.
+    При нескольких воркерах отметки живут в SQLite (sendData и POST могут прийти в разные процессы)."""
+    _seen: "OrderedDict[str, float]" = OrderedDict()   # key -> monotonic-время приёма
+    _db: Optional[sqlite3.Connection] = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def _shared(cls) -> sqlite3.Connection:
+        if cls._db is None:
+            conn = open_db()
+            conn.execute("CREATE TABLE IF NOT EXISTS lead_dedup (key TEXT PRIMARY KEY, at REAL NOT NULL)")
+            cls._db = conn
+        return cls._db
+
+    @staticmethod
+    def key(nonce, company: str, task: str, contact: str) -> str:
+        h = hashlib.sha1()
+        for part in (str(nonce or "").strip()[:128], company, task, contact):
+            h.update(part.encode("utf-8", "replace"))
+            h.update(b"\0")
+        return h.hexdigest()
+
+    @classmethod
+    def _expire(cls, now: float) -> None:
+        seen = cls._seen
+        while seen:
+            k, at = next(iter(seen.items()))
+            if now - at < LEAD_DEDUP_TTL_SEC and len(seen) <= LEAD_DEDUP_MAX:
+                break
+            seen.popitem(last=False)
+
+    @classmethod
+    def _claim_shared(cls, key: str) -> bool:
+        now = time.time()
+        with cls._lock:
+            db = cls._shared()
+            if random.random() < 0.01:
+                db.execute("DELETE FROM lead_dedup WHERE at < ?", (now - LEAD_DEDUP_TTL_SEC,))
+            # вставка проходит, если ключа нет или отметка устарела — атомарно для всех процессов
+            return db.execute(
+                "INSERT INTO lead_dedup(key, at) VALUES (?, ?)"
+                " ON CONFLICT(key) DO UPDATE SET at = excluded.at WHERE lead_dedup.at < ?",
+                (key, now, now - LEAD_DEDUP_TTL_SEC),
+            ).rowcount > 0
+
+    @classmethod
+    def _release_shared(cls, key: str) -> None:
+        with cls._lock:
+            cls._shared().execute("DELETE FROM lead_dedup WHERE key = ?", (key,))
+
+    @classmethod
+    async def claim(cls, key: str) -> bool:
+        """True — лид новый (и теперь помечен); False — такой уже принят в окне TTL."""
+        if MULTI_WORKER:
+            return await asyncio.to_thread(cls._claim_shared, key)   # запись в общую SQLite — не на event loop
+        now = time.monotonic()
+        cls._expire(now)
+        if key in cls._seen:
+            return False
+        cls._seen[key] = now
+        return True
+
+    @classmethod
+    async def release(cls, key: str) -> None:
+        """Снять отметку (лид не удалось поставить в очередь — повтор должен пройти)."""
+        if MULTI_WORKER:
+            await asyncio.to_thread(cls._release_shared, key)
+            return
+        cls._seen.pop(key, None)
 
 MAX_TG = 3900
-def build_lead(kind: str, m: Optional[Message], company: str, task: str, contact: str) -> str:
-    who = f"От: {ufmt(m)}\n" if m else "От: неизвестно (браузер)\n"
+
+def cut_text(s: str, n: int) -> str:
+    s = s.strip()
+    return s[: n-1] + "…" if len(s) > n else s
+
+# --- дайджест лидов (LEADS_DIGEST_WINDOW_SEC > 0): несколько лидов одним постом ≤ MAX_TG ---
+DIGEST_SEP = "\n\n➖➖➖\n\n"
+
+def _digest_header(n: int) -> str:
+    return f"📦 Лиды: {n}\n\n"
+
+def digest_fit(texts: list[str]) -> int:
+    """Сколько первых лидов влезает в один пост (минимум 1 — одиночный лид уходит как есть)."""
+    total = len(_digest_header(len(texts)))
+    for i, t in enumerate(texts):
+        total += len(t) + (len(DIGEST_SEP) if i else 0)
+        if total > MAX_TG:
+            return max(1, i)
+    return len(texts)
+
+def digest_text(texts: list[str]) -> str:
+    if len(texts) == 1:
+        return cut_text(texts[0], MAX_TG)   # старые/чужие записи могли быть длиннее лимита
+    return _digest_header(len(texts)) + DIGEST_SEP.join(texts)
+
+def build_lead(kind: str, m: Optional[Message], company: str, task: str, contact: Contact,
+               sender_html: Optional[str] = None) -> str:
+    if m:
+        who = f"От: {ufmt(m)}\n"
+    elif sender_html:
+        who = f"От: {sender_html}\n"
+    else:
+        who = "От: неизвестно (браузер)\n"
     comp = (company or "").strip()
     tsk  = (task or "").strip()
-    cnt  = (contact or "").strip()
+    cnt  = contact.label().strip()
     base = f"🧪 Заявка ({kind})\n{who}"
     body = (
         f"Компания: {esc(comp) or '—'}\n"
@@ -444,11 +2136,8 @@ def build_lead(kind: str, m: Optional[Message], company: str, task: str, contact
 
     comp_max = max(150, int((MAX_TG - len(base) - 100) * 0.45))
     tsk_max  = max(150, int((MAX_TG - len(base) - 100) * 0.45))
-    def cut(s: str, n: int) -> str:
-        s = s.strip()
-        return s[: n-1] + "…" if len(s) > n else s
-    comp2 = cut(comp, comp_max)
-    tsk2  = cut(tsk,  tsk_max)
+    comp2 = cut_text(comp, comp_max)
+    tsk2  = cut_text(tsk,  tsk_max)
     txt2 = base + (
         f"Компания: {esc(comp2) or '—'}\n"
         f"Задача: {esc(tsk2) or '—'}\n"
@@ -457,7 +2146,7 @@ def build_lead(kind: str, m: Optional[Message], company: str, task: str, contact
         f"UTC: {datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M')}"
     )
     if len(txt2) > MAX_TG:
-        tsk2 = cut(tsk2, max(120, tsk_max - (len(txt2) - MAX_TG + 20)))
+        tsk2 = cut_text(tsk2, max(120, tsk_max - (len(txt2) - MAX_TG + 20)))
         txt2 = base + (
             f"Компания: {esc(comp2) or '—'}\n"
             f"Задача: {esc(tsk2) or '—'}\n"
@@ -472,10 +2161,10 @@ PROMO_DISCOUNT_PCT = 20  # % скидки для этого промо
 
 def get_promo_record_by_code(code: str) -> Optional[tuple[int, dict]]:
     """Быстрый поиск: из кода получаем (user_id, запись) или None."""
-    uid = Store.promos_by_code.get((code or "").strip())
+    uid = db.promo_owner((code or "").strip())
     if uid is None:
         return None
-    rec = Store.promos.get(uid)
+    rec = db.get_promo(uid)
     if not rec or rec.get("code") != code:
         return None
     return uid, rec
@@ -512,47 +2201,163 @@ def redeem_promo(user_id: int, code: str) -> tuple[bool, str, Optional[int]]:
     # помечаем использованным
     uid, rec = get_promo_record_by_code(code)  # точно есть
     rec["used"] = True
-    Store.promos[uid] = rec
+    db.put_promo(uid, rec)
     return True, "Промокод применён", disc
 
-async def promo_reminder_loop():
-    while True:
+class ReminderScheduler:
+    """Мин-куча (время следующего пинга, user_id): цикл спит ровно до ближайшего напоминания.
+    Забранные/истёкшие офферы из кучи убираются (ленивое удаление по версии в `_due`)."""
+    def __init__(self):
+        self._heap: list[tuple[float, int]] = []
+        self._due: dict[int, float] = {}     # user_id -> актуальное время пинга (ts)
+        self._wakeup: Optional[asyncio.Event] = None
+
+    def __len__(self) -> int:
+        return len(self._due)
+
+    @staticmethod
+    def next_reminder_at(offer: dict) -> Optional[datetime]:
+        if offer.get("claimed"):
+            return None
+        last = offer.get("last_reminder")
+        if last is None:
+            at = offer["start"] + timedelta(seconds=REMINDER_LOOP_INTERVAL_SEC)
+        else:
+            at = last + timedelta(hours=PROMO_REMINDER_EVERY_HOURS)
+        return at if at < offer["expires"] else None
+
+    def schedule(self, user_id: int, offer: dict, at: Optional[datetime] = None) -> None:
+        at = at or self.next_reminder_at(offer)
+        if at is None:
+            self.cancel(user_id)
+            return
+        ts = at.timestamp()
+        self._due[user_id] = ts
+        heapq.heappush(self._heap, (ts, user_id))
+        if len(self._heap) > 2 * len(self._due) + 64:
+            self._heap = [(t, u) for u, t in self._due.items()]
+            heapq.heapify(self._heap)
+        if self._wakeup is not None and self._heap[0][1] == user_id:
+            self._wakeup.set()   # новый пинг раньше, чем тот, до которого спим
+
+    def cancel(self, user_id: int) -> None:
+        self._due.pop(user_id, None)
+
+    def clear(self) -> None:
+        self._heap, self._due = [], {}
+
+    def adopt(self, offers: list[tuple[int, dict]]) -> int:
+        """Добавляет офферы, которых ещё нет в куче (созданы другими воркерами). Свои расписания не трогает."""
+        n = 0
+        for uid, offer in offers:
+            if uid not in self._due:
+                at = self.next_reminder_at(offer)
+                if at is not None:
+                    self.schedule(uid, offer, at=at)
+                    n += 1
+        return n
+
+    def load(self, offers: list[tuple[int, dict]]) -> None:
+        for uid, offer in offers:
+            at = self.next_reminder_at(offer)
+            if at is not None:
+                self._due[uid] = at.timestamp()
+        self._heap = [(t, u) for u, t in self._due.items()]
+        heapq.heapify(self._heap)
+
+    def _drop_stale_head(self) -> None:
+        while self._heap and self._due.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+
+    def seconds_until_next(self) -> Optional[float]:
+        self._drop_stale_head()
+        return max(0.0, self._heap[0][0] - time.time()) if self._heap else None
+
+    def pop_due(self) -> list[int]:
+        now = time.time()
+        out = []
+        self._drop_stale_head()
+        while self._heap and self._heap[0][0] <= now:
+            ts, uid = heapq.heappop(self._heap)
+            del self._due[uid]
+            Metrics.reminder_lag.observe(now - ts)
+            out.append(uid)
+            self._drop_stale_head()
+        return out
+
+    async def wait(self, max_delay: Optional[float] = None) -> None:
+        """Спит до ближайшего пинга или до schedule() с более ранним временем (но не дольше max_delay)."""
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        delay = self.seconds_until_next()
+        if max_delay is not None:
+            delay = max_delay if delay is None else min(delay, max_delay)
+        if delay == 0:
+            return
+        self._wakeup.clear()
         try:
-            now = now_utc()
-            for uid, offer in list(Store.gift_offer.items()):
-                # уже забрал или истекло окно — пропускаем
-                if offer.get("claimed"):
-                    continue
-                if now >= offer["expires"]:
-                    continue
+            await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+        except asyncio.TimeoutError:
+            pass
 
-                last = offer.get("last_reminder")
-                # нужен ли пинг сейчас?
-                if last is not None and (now - last).total_seconds() < PROMO_REMINDER_EVERY_HOURS * 3600:
-                    continue
+reminders = ReminderScheduler()
 
-                left = offer["expires"] - now
-                kb = InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="🎟 Получить промокод −20%", callback_data="gift_promo")]
-                ])
-                try:
-                    await bot.send_message(
-                        uid,
-                        f"Нежное напоминание 💙\nВаш бонус −20% ещё активен.\nОсталось: {humanize_timedelta(left)}",
-                        reply_markup=kb,
-                        disable_web_page_preview=True
-                    )
-                    offer["last_reminder"] = now
-                except Exception as e:
-                    log.warning("Promo reminder to %s failed: %s", uid, e)
+async def _send_promo_reminder(uid: int, kb: InlineKeyboardMarkup) -> None:
+    now = now_utc()
+    offer = db.get_offer(uid)
+    # уже забрал или истекло окно — пропускаем
+    if not offer or not _offer_is_open(offer, now):
+        return
+    left = offer["expires"] - now
+    ok = await sender.send(
+        uid,
+        f"Нежное напоминание 💙\nВаш бонус −20% ещё активен.\nОсталось: {humanize_timedelta(left)}",
+        reply_markup=kb,
+        disable_web_page_preview=True
+    )
+    if ok:
+        offer["last_reminder"] = now
+        db.put_offer(uid, offer)
+        reminders.schedule(uid, offer)
+    elif not db.is_blocked(uid):
+        retry_at = now + timedelta(seconds=REMINDER_LOOP_INTERVAL_SEC)
+        if retry_at < offer["expires"]:
+            reminders.schedule(uid, offer, at=retry_at)
 
+REMINDER_RESYNC_SEC = 30   # при нескольких воркерах: как часто лидер подбирает офферы, созданные другими
+
+async def promo_reminder_loop():
+    """Крутится только на лидере (см. Leader): иначе каждый воркер слал бы свои напоминания."""
+    reminders.load(db.open_offers(now_utc()))
+    log.info("promo reminders scheduled: %s", len(reminders))
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🎟 Получить промокод −20%", callback_data="gift_promo")]
+    ])
+    resync_at = time.monotonic() + REMINDER_RESYNC_SEC
+    while True:
+        try:
+            await reminders.wait(REMINDER_RESYNC_SEC if MULTI_WORKER else None)
+            if MULTI_WORKER and time.monotonic() >= resync_at:
+                resync_at = time.monotonic() + REMINDER_RESYNC_SEC
+                n = reminders.adopt(db.open_offers(now_utc()))
+                if n:
+                    log.info("promo reminders adopted from other workers: %s", n)
+            due = reminders.pop_due()
+            if due:
+                # параллельно; темп держит sender (глобальный и per-chat лимиты)
+                await asyncio.gather(*(_send_promo_reminder(uid, kb) for uid in due))
+
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
             log.exception("promo_reminder_loop error: %s", e)
-
-        await asyncio.sleep(REMINDER_LOOP_INTERVAL_SEC)
+            await asyncio.sleep(1)
 
 # ---------- UI ----------
 def main_kb(is_private: bool, is_admin: bool) -> InlineKeyboardMarkup:
+    return RenderCache.get(_build_main_kb, bool(is_private), bool(is_admin))
+
+def _build_main_kb(is_private: bool, is_admin: bool) -> InlineKeyboardMarkup:
     webapp_btn = (
         InlineKeyboardButton(
             text="🧪 Квиз (в Telegram)",
@@ -582,14 +2387,15 @@ def main_kb(is_private: bool, is_admin: bool) -> InlineKeyboardMarkup:
 # ---------- HANDLERS ----------
 @dp.message(CommandStart())
 async def on_start(m: Message, state: FSMContext):
-    Store.stats["starts"] += 1
-    Store.users.add(m.from_user.id)
+    db.incr("starts")
+    db.add_user(m.from_user.id)
+    if db.is_blocked(m.from_user.id):
+        db.set_blocked(m.from_user.id, False)   # вернулся — снова можно писать
     parts = (m.text or "").split(maxsplit=1)
     arg = parts[1].strip().lower() if len(parts) > 1 else ""
 
-    hero = os.path.join(os.path.dirname(__file__), "assets", "hero.png")
     try:
-        await m.answer_photo(FSInputFile(hero), caption=header())
+        await MediaCache.answer_photo(m, AssetVariants.photo_path(), caption=header())
     except Exception:
         await m.answer(header())
 
@@ -619,7 +2425,7 @@ async def on_menu(m: Message):
 
 @dp.message(Command("stats"))
 async def on_stats(m: Message):
-    s = Store.stats
+    s = db.stats()
     await m.answer(f"stats → starts={s['starts']}, webquiz={s['webquiz']}, chatquiz={s['quiz']}, orders={s['orders']}")
 
 @dp.message(Command("chatid"))
@@ -629,69 +2435,88 @@ async def cmd_chatid(m: Message): await m.answer(f"chat_id: <code>{m.chat.id}</c
 async def cmd_threadid(m: Message): await m.answer(f"thread_id: <code>{getattr(m, 'message_thread_id', None)}</code>")
 
 # --- Диагностика/управление лид-чатом ---
+def _routes_html() -> str:
+    return "\n".join(f"• {esc(sel)} → <code>{esc(', '.join(str(t) for t in ts))}</code>"
+                     for sel, ts in LeadRouter.routes.items())
+
 @dp.message(Command("get_leads"))
 async def cmd_get_leads(m: Message):
     if m.from_user.id != ADMIN_CHAT_ID: return
-    await m.answer(f"LEADS_CHAT_ID: <code>{esc(LEADS_RAW)}</code>\nLEADS_THREAD_ID: <code>{LEADS_THREAD_ID or '—'}</code>")
+    await m.answer(f"Маршруты лидов:\n{_routes_html()}")
 
 @dp.message(Command("set_leads"))
 async def cmd_set_leads(m: Message):
     if m.from_user.id != ADMIN_CHAT_ID: return
     parts = (m.text or "").split(maxsplit=1)
     if len(parts) < 2:
-        return await m.answer("Использование: /set_leads -1001234567890 ИЛИ /set_leads @channel")
-    global LEADS_RAW
-    LEADS_RAW = parts[1].strip()
-    await m.answer(f"LEADS_CHAT_ID → <code>{esc(LEADS_RAW)}</code>")
+        return await m.answer(
+            "Использование:\n"
+            "/set_leads -1001234567890 (или @channel, или -100…/ID_темы) — сменить чат по умолчанию\n"
+            "/set_leads default=-100…; webapp=-100…; order:pro=-100…/12,-100… — вся таблица\n"
+            "/set_leads reset — вернуть из env"
+        )
+    arg = parts[1].strip()
+    try:
+        if arg.lower() == "reset":
+            LeadRouter.reset()
+        elif "=" in arg:
+            LeadRouter.set(arg)
+        else:
+            LeadRouter.set_default(arg)
+    except ValueError as e:
+        return await m.answer(f"❌ Таблица не изменена: <code>{esc(str(e))}</code>")
+    LeadsChatCache.invalidate()
+    chats = list(dict.fromkeys(t.chat for t in LeadRouter.targets()))
+    results = await asyncio.gather(*(LeadsChatCache.refresh(c) for c in chats), return_exceptions=True)
+    notes = []
+    for chat_id, r in zip(chats, results):
+        if isinstance(r, Exception):
+            notes.append(f"⚠️ {esc(str(chat_id))}: get_chat: <code>{esc(str(r))}</code>")
+        else:
+            notes.append(f"{esc(str(chat_id))}: {esc(getattr(r, 'title', None) or '—')} (forum={getattr(r, 'is_forum', False)})")
+    await m.answer(f"Маршруты лидов:\n{_routes_html()}\n\n" + "\n".join(notes))
+
+async def _probe_report(text: str) -> str:
+    return "\n".join(f"{'OK' if e is None else 'FAIL'} → <code>{esc(str(t))}</code>"
+                     + ("" if e is None else f": {esc(str(e))}") for t, e in await _send_to_leads(text))
 
 @dp.message(Command("leads_probe"))
 async def leads_probe(m: Message):
     if m.from_user.id != ADMIN_CHAT_ID: return
-    ok = await _send_to_leads("🔔 PROBE to leads")
-    await m.answer(f"leads_probe → {'OK' if ok else 'FAIL'} (target={esc(str(LEADS_RAW))}, thread={LEADS_THREAD_ID or '—'})")
+    await m.answer("leads_probe:\n" + await _probe_report("🔔 PROBE to leads"))
 
 @dp.message(Command("check_leads"))
 async def check_leads(m: Message):
-    target_raw = LEADS_RAW
-    def _parse(s: str):
-        s = (s or "").strip()
-        if not s: return None
-        if s.startswith("@"): return s
-        try: return int(s)
-        except ValueError: return None
-    target = _parse(target_raw)
-    if not target:
-        return await m.answer("LEADS_CHAT_ID не задан или некорректен.")
-    try:
-        me = await bot.get_me()
-        chat = await bot.get_chat(target)
-        member = await bot.get_chat_member(chat.id, me.id)
-        def g(obj, attr, default="—"): return getattr(obj, attr, default)
-        info = (
+    chats = list(dict.fromkeys(t.chat for t in LeadRouter.targets()))
+    if not chats:
+        return await m.answer("Маршруты лидов не заданы.")
+    def g(obj, attr, default="—"): return getattr(obj, attr, default)
+    async def one(target) -> str:
+        try:
+            chat = await LeadsChatCache.refresh(target)
+            member = await bot.get_chat_member(chat.id, me.id)
+        except Exception as e:
+            return f"❌ Не удалось прочитать чат {esc(repr(target))}:\n<code>{esc(str(e))}</code>"
+        return (
             "📊 Лид-чат найден:\n"
             f"• chat.id: <code>{chat.id}</code>\n"
             f"• type: {g(chat, 'type')}\n"
-            f"• title: {g(chat, 'title')}\n"
+            f"• title: {esc(str(g(chat, 'title')))}\n"
             f"• is_forum: {g(chat, 'is_forum', False)}\n"
             f"• бот в чате как: {g(member, 'status')}\n"
             f"• can_send_messages: {g(member, 'can_send_messages', '—')}\n"
             f"• can_post_messages: {g(member, 'can_post_messages', '—')}\n"
         )
-        await m.answer(info)
+    try:
+        me = await bot.get_me()
     except Exception as e:
-        await m.answer(f"❌ Не удалось прочитать чат {target_raw!r}:\n<code>{e}</code>")
+        return await m.answer(f"❌ get_me: <code>{esc(str(e))}</code>")
+    await m.answer("\n".join(await asyncio.gather(*(one(c) for c in chats))))
 
 @dp.message(Command("test_leads"))
 async def test_leads_cmd(m: Message):
     if m.from_user.id != ADMIN_CHAT_ID: return
-    try:
-        kwargs = {}
-        if LEADS_THREAD_ID:
-            kwargs["message_thread_id"] = LEADS_THREAD_ID
-        await bot.send_message(parse_leads_target(LEADS_RAW), "🔔 Тест в чат лидов: работает ✅", **kwargs)
-        await m.answer(f"OK → {LEADS_RAW!r} (thread={LEADS_THREAD_ID or '—'})")
-    except Exception as e:
-        await m.answer(f"❌ Не отправилось в {LEADS_RAW!r}:\n<code>{e}</code>")
+    await m.answer("test_leads:\n" + await _probe_report("🔔 Тест в чат лидов: работает ✅"))
 
 # --- Меню / контент ---
 @dp.callback_query(F.data == "hide_menu")
@@ -730,27 +2555,27 @@ async def cb_prices(c: CallbackQuery):
 
 @dp.callback_query(F.data == "pkg_lite")
 async def cb_pkg_lite(c: CallbackQuery):
-    await safe_edit(c, pkg_text("lite"), pkg_kb())
+    await safe_edit(c, pkg_text("lite"), pkg_kb("lite"))
     await c.answer()
 
 @dp.callback_query(F.data == "pkg_start")
 async def cb_pkg_start(c: CallbackQuery):
-    await safe_edit(c, pkg_text("start"), pkg_kb())
+    await safe_edit(c, pkg_text("start"), pkg_kb("start"))
     await c.answer()
 
 @dp.callback_query(F.data == "pkg_pro")
 async def cb_pkg_pro(c: CallbackQuery):
-    await safe_edit(c, pkg_text("pro"), pkg_kb())
+    await safe_edit(c, pkg_text("pro"), pkg_kb("pro"))
     await c.answer()
 
 @dp.callback_query(F.data == "pkg_ent")
 async def cb_pkg_ent(c: CallbackQuery):
-    await safe_edit(c, pkg_text("ent"), pkg_kb())
+    await safe_edit(c, pkg_text("ent"), pkg_kb("ent"))
     await c.answer()
 
 @dp.callback_query(F.data == "pkg_support")
 async def cb_pkg_support(c: CallbackQuery):
-    await safe_edit(c, pkg_text("support"), pkg_kb())
+    await safe_edit(c, pkg_text("support"), pkg_kb("support"))
     await c.answer()
 
 # --- Контакты + «написать админу» ---
@@ -777,17 +2602,46 @@ async def cb_admin_open(c: CallbackQuery):
     if not is_admin(c.from_user.id):
         await c.answer("Только для владельца бота", show_alert=True); return
     uptime = datetime.now(timezone.utc) - Store.started_at
-    s = Store.stats
+    s = db.stats()
+    ss = sender.stats()
     txt = (f"<b>🛠 Админ-панель</b>\n"
            f"Uptime: {str(uptime).split('.',1)[0]}\n"
-           f"Уникальных пользователей: <b>{len(Store.users)}</b>\n"
-           f"Starts: {s['starts']} | WebQuiz: {s['webquiz']} | ChatQuiz: {s['quiz']} | Orders: {s['orders']} | Msgs→Admin: {s['contact_msgs']}\n")
+           f"Уникальных пользователей: <b>{db.users_count()}</b>\n"
+           f"Starts: {s['starts']} | WebQuiz: {s['webquiz']} | ChatQuiz: {s['quiz']} | Orders: {s['orders']} | Msgs→Admin: {s['contact_msgs']}\n"
+           f"Рассылки: sent={ss['sent']} | fail={ss['failed']} | blocked={ss['blocked']} | skip={ss['skipped']} | 429={ss['retry_after']} | {ss['per_sec']} msg/s\n")
+    es = ErrorReports.stats()
+    txt += (f"Ошибки: {es['total']} ({es['kinds']} видов, активных {es['active']}) | "
+            f"отчётов админу: {es['reports']} | свёрнуто: {es['suppressed']}\n")
+    for fp, n in es["top"]:
+        txt += f"  • <code>{esc(fp)}</code> ×{n}\n"
     kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="📈 Обновить", callback_data="admin_open")],
+        [InlineKeyboardButton(text="📈 Обновить", callback_data="admin_open"),
+         InlineKeyboardButton(text="📣 Тест-рассылка", callback_data="admin_test_bcast")],
         [InlineKeyboardButton(text="⬅️ Меню", callback_data="go_menu")]
     ])
     await safe_edit(c, txt, kb); await c.answer()
 
+@dp.callback_query(F.data == "admin_test_bcast")
+async def cb_admin_test_bcast(c: CallbackQuery):
+    if not is_admin(c.from_user.id):
+        await c.answer("Только для владельца бота", show_alert=True); return
+    res = await sender.broadcast([ADMIN_CHAT_ID], "📣 Тест-рассылка: так увидят сообщение пользователи.")
+    await c.answer(f"Тест-рассылка: ok={res['ok']}, fail={res['fail']}", show_alert=True)
+
+@dp.message(Command("broadcast"))
+async def cmd_broadcast(m: Message):
+    if not is_admin(m.from_user.id): return
+    parts = (m.text or "").split(maxsplit=1)
+    if len(parts) < 2:
+        return await m.answer("Использование: /broadcast текст (HTML) — разошлёт всем пользователям бота.")
+    ids = await db.active_user_ids()
+    await m.answer(f"📣 Рассылка запущена: {len(ids)} получателей.")
+
+    async def _run():
+        res = await sender.broadcast(ids, parts[1], disable_web_page_preview=True)
+        await notify_admin(f"📣 Рассылка завершена: ok={res['ok']}, fail={res['fail']} из {res['total']} за {res['sec']} с")
+    spawn(_run(), name="broadcast")
+
 # --- Сообщение админу (FSM) ---
 @dp.message(AdminMsg.text, F.text.casefold() == "отмена")
 async def contact_cancel(m: Message, state: FSMContext):
@@ -802,7 +2656,7 @@ async def contact_text(m: Message, state: FSMContext):
     if left > 0:
         await m.answer(f"Антиспам: подождите ещё {left} сек перед следующим сообщением админу 🙂")
         return
-    Store.stats["contact_msgs"] += 1
+    db.incr("contact_msgs")
     if ADMIN_CHAT_ID:
         txt = f"✉️ Сообщение админу от {ufmt(m)}:\n\n{esc(m.text)}"
         await bot.send_message(ADMIN_CHAT_ID, txt, disable_web_page_preview=True)
@@ -818,7 +2672,7 @@ async def contact_any(m: Message, state: FSMContext):
     if left > 0:
         await m.answer(f"Антиспам: подождите ещё {left} сек перед следующим сообщением админу 🙂")
         return
-    Store.stats["contact_msgs"] += 1
+    db.incr("contact_msgs")
     if ADMIN_CHAT_ID:
         head = f"✉️ Сообщение админу от {ufmt(m)} (медиа ниже)"
         await bot.send_message(ADMIN_CHAT_ID, head)
@@ -857,15 +2711,15 @@ async def cb_gift(c: CallbackQuery):
 @dp.callback_query(F.data == "gift_pdf")
 async def cb_gift_pdf(c: CallbackQuery):
     uid = c.from_user.id
-    pdf_path = os.path.join(os.path.dirname(__file__), "assets", "gifts", "checklist.pdf")
+    pdf_path = os.path.join(ASSETS_DIR, "gifts", "checklist.pdf")
     caption = ("<b>Чек-лист: «Бот, который окупится за 48 часов»</b>\n"
                "Цель • Меню • УТП • Квиз • Лиды • Автоответ • Оффер • Кейсы • Память • Правки • Рассылки • Цифры")
     try:
         if os.path.exists(pdf_path):
-            await c.message.answer_document(FSInputFile(pdf_path), caption=caption)
+            await MediaCache.answer_document(c.message, pdf_path, caption=caption)
         else:
             await c.message.answer(caption)
-        Store.gift_claimed.add(uid)
+        db.mark_gift_claimed(uid)
         await notify_admin(f"🎁 PDF чек-лист выдан: {c.from_user.full_name} (@{c.from_user.username or '—'})")
     except Exception as e:
         await c.message.answer(f"Не удалось отправить PDF: <code>{esc(str(e))}</code>")
@@ -888,7 +2742,7 @@ async def cb_gift_promo(c: CallbackQuery):
         return
 
     # Если уже выдавали промо — повторно просто показываем тот же код и оставшееся время
-    promo = Store.promos.get(uid)
+    promo = db.get_promo(uid)
     if promo:
         left = max(timedelta(0), promo["expires_dt"] - now)
         txt = (
@@ -904,6 +2758,8 @@ async def cb_gift_promo(c: CallbackQuery):
     # Выдаём новый код с истечением ровно по окну оффера
     promo = gen_promo_for(uid, expires_at=offer["expires"])
     offer["claimed"] = True  # чтобы перестать слать напоминания
+    db.put_offer(uid, offer)
+    reminders.cancel(uid)
 
     left = max(timedelta(0), offer["expires"] - now)
     txt = (
@@ -923,44 +2779,46 @@ async def cb_gift_promo(c: CallbackQuery):
     await c.answer()
 
 # --- Заказ (контакт) ---
-@dp.callback_query(F.data == "go_order")
+@dp.callback_query(F.data.startswith("go_order"))
 async def order_start(c: CallbackQuery, state: FSMContext):
     if not Store.accepting:
         return await c.answer("Приём заявок временно закрыт", show_alert=True)
+    pkg = c.data.partition(":")[2]
     await state.set_state(Order.contact)
+    await state.set_data({"pkg": pkg} if pkg in PRICING else {})
     kb = ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True, keyboard=[[KeyboardButton(text="Отправить мой номер", request_contact=True)]])
     await c.message.answer("Оставьте телефон или напишите контакт (телеграм/почта):", reply_markup=kb)
     await c.answer()
 
 @dp.message(Order.contact, F.contact)
 async def order_contact_obj(m: Message, state: FSMContext):
-    phone = sanitize_phone(m.contact.phone_number)
-    if not phone:
+    ct = parse_contact(m.contact.phone_number, international=True)
+    if ct is None or ct.kind != "phone":
         return await m.answer("Телефон некорректный. Пришлите ещё раз или укажите @username/email.")
-    await finalize_order(m, state, phone=phone)
+    await finalize_order(m, state, ct)
 
 @dp.message(Order.contact)
 async def order_contact_text(m: Message, state: FSMContext):
-    txt = (m.text or "").strip()
-    phone = sanitize_phone(txt)
-    if not (phone or valid_contact(txt)):
+    ct = parse_contact(m.text)
+    if ct is None:
         await m.answer("Контакт обязателен: @username, телефон (7–15 цифр) или email.")
         return
-    await finalize_order(m, state, phone=phone, raw=txt)
+    await finalize_order(m, state, ct)
 
-async def finalize_order(m: Message, state: FSMContext, phone: Optional[str], raw: Optional[str] = None):
+async def finalize_order(m: Message, state: FSMContext, contact: Contact):
+    pkg = (await state.get_data()).get("pkg")
     await state.clear()
-    Store.stats["orders"] += 1
-    clean = phone or (raw.strip() if raw else "—")
+    db.incr("orders")
     msg = ("🛒 Заказ/контакт\n"
            f"От: {ufmt(m)}\n"
-           f"Контакт: {esc(clean)}\n"
+           + (f"Тариф: {esc(PRICING[pkg]['title'])}\n" if pkg in PRICING else "") +
+           f"Контакт: {esc(contact.label())}\n"
            f"UTC: {datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M')}")
     await m.answer("Спасибо! Мы на связи.", reply_markup=ReplyKeyboardRemove())
     await m.answer("Главное меню:", reply_markup=main_kb(is_private=(m.chat.type == "private"), is_admin=is_admin(m.from_user.id)))
-    delivered = await _send_to_leads(msg)  # только в группу
-    if not delivered and ADMIN_CHAT_ID:
-        await notify_admin("⚠️ Лид-чат недоступен, проверьте окружение/права.")
+    queued = await Outbox.put(msg, f"order:{pkg}" if pkg in PRICING else "order")  # только в группу (через очередь)
+    if not queued and ADMIN_CHAT_ID:
+        await notify_admin("⚠️ Очередь лидов недоступна, проверьте диск/окружение.")
 
 # --- Чат-квиз (ForceReply) ---
 @dp.callback_query(F.data == "go_quiz")
@@ -1006,28 +2864,28 @@ async def quiz_done(m: Message, state: FSMContext):
         return await m.answer("Поле обязательно. Укажи срок запуска (не пусто).")
     data = await state.update_data(deadline=txt[:100])
     await state.clear()
-    Store.stats["quiz"] += 1
+    db.incr("quiz")
     msg = ("🆕 Заявка (квиз-чат)\n"
            f"От: {ufmt(m)}\n"
            f"Ниша: {esc(data.get('niche'))}\n"
            f"Цель: {esc(data.get('goal'))}\n"
            f"Срок: {esc(data.get('deadline'))}\n"
            f"UTC: {datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M')}")
-    delivered = await _send_to_leads(msg)  # только в группу
+    queued = await Outbox.put(msg, "quiz")  # только в группу (через очередь)
     ack = "Ваша анкета отправлена, спасибо! ✅"
-    if not delivered and ADMIN_CHAT_ID:
-        await notify_admin("⚠️ Лид-чат недоступен, проверьте окружение/права.")
+    if not queued:
         ack += f"\n{LEADS_FAIL_MSG}"
+        if ADMIN_CHAT_ID:
+            await notify_admin("⚠️ Очередь лидов недоступна, проверьте диск/окружение.")
     await m.answer(ack, reply_markup=main_kb(is_private=(m.chat.type == "private"),
                                              is_admin=is_admin(m.from_user.id)))
 
 # --- Приём данных из Telegram WebApp (строгая валидация) ---
 @dp.message(F.web_app_data)
 async def on_webapp_data(m: Message):
-    Store.stats["webquiz"] += 1
-
     raw = m.web_app_data.data
-    log.info("WEBAPP DATA RAW: %s", raw)
+    # только метаданные: сам payload содержит контакты
+    log_event("webapp_data", user_id=m.from_user.id, size=len(raw or ""))
 
     try:
         data = json.loads(raw)
@@ -1039,50 +2897,220 @@ async def on_webapp_data(m: Message):
     task    = (data.get("task") or "").strip()[:20000]
     contact = (data.get("contact") or "").strip()[:500]
 
-    ok, err = validate_web_quiz(comp, task, contact)
-    if not ok:
+    ct, err = validate_web_quiz(comp, task, contact)
+    if ct is None:
         await m.answer(f"❗️{err}")
         return
 
-    await m.answer("📥 Приняли данные из WebApp, отправляю в лид-чат…")
+    ack = "Ваша анкета отправлена, спасибо! ✅"
+    dedup_key = LeadDedup.key(data.get("nonce"), comp, task, ct.value)
+    if not await LeadDedup.claim(dedup_key):
+        # эту же анкету уже принял HTTP-бэкап (/webapp/submit) — второй лид не шлём
+        log_event("lead_duplicate", source="webapp_data", user_id=m.from_user.id)
+        await m.answer(ack, reply_markup=main_kb(is_private=(m.chat.type == "private"),
+                                                 is_admin=is_admin(m.from_user.id)))
+        return
+    db.incr("webquiz")
 
-    txt = build_lead("WebApp", m, comp, task, contact)
-    delivered = await _send_to_leads(txt)
+    txt = build_lead("WebApp", m, comp, task, ct)
+    queued = await Outbox.put(txt, "webapp")
 
-    ack = "Ваша анкета отправлена, спасибо! ✅"
-    if not delivered:
+    if not queued:
+        await LeadDedup.release(dedup_key)
         ack += "\n" + LEADS_FAIL_MSG
         if ADMIN_CHAT_ID:
-            await notify_admin("⚠️ Лид-чат недоступен, проверьте окружение/права.")
+            await notify_admin("⚠️ Очередь лидов недоступна, проверьте диск/окружение.")
     await m.answer(ack, reply_markup=main_kb(is_private=(m.chat.type == "private"),
                                              is_admin=is_admin(m.from_user.id)))
 
 # ---------- FASTAPI ----------
 app = FastAPI(title="Vimly — Client Demo Bot (WebApp)")
 
-# HTTP-fallback для браузера (строгая валидация) — ТОЛЬКО в группу
+@app.middleware("http")
+async def http_metrics(request: Request, call_next):
+    t0 = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        endpoint = request.scope.get("endpoint")
+        name = getattr(endpoint, "__name__", None) or "unmatched"
+        if name != "metrics":
+            Metrics.handler_seconds.observe(time.perf_counter() - t0, "http", name)
+            Metrics.http_requests.inc(name, status)
+
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def metrics(request: Request):
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    return PlainTextResponse(Metrics.render(), media_type="text/plain; version=0.0.4")
+
+# --- admission control для публичных POST ---
+def _bucket_take(tokens: float, updated: float, now: float, rate: float, burst: float) -> tuple[float, float]:
+    """Шаг токен-бакета: (новые токены, сколько ждать; 0 — пропускаем)."""
+    tokens = min(burst, tokens + (now - updated) * rate)
+    if tokens >= 1:
+        return tokens - 1, 0.0
+    return tokens, (1 - tokens) / rate
+
+class MemoryRateLimiter:
+    """Токен-бакеты по ключу в памяти процесса; LRU, чтобы поток новых IP не раздувал словарь."""
+    MAX_KEYS = 50000
+
+    def __init__(self, per_min: float, burst: float):
+        self.rate, self.burst = per_min / 60.0, max(1.0, burst)
+        self.buckets: "OrderedDict[str, tuple[float, float]]" = OrderedDict()
+
+    def hit(self, key: str) -> float:
+        now = time.monotonic()
+        tokens, updated = self.buckets.pop(key, (self.burst, now))
+        tokens, wait = _bucket_take(tokens, updated, now, self.rate, self.burst)
+        self.buckets[key] = (tokens, now)
+        if len(self.buckets) > self.MAX_KEYS:
+            self.buckets.popitem(last=False)
+        return wait
+
+    async def take(self, keys: list[str]) -> float:
+        return max(self.hit(k) for k in keys)
+
+class SQLiteRateLimiter:
+    """Те же бакеты в общей SQLite — лимит один на все процессы."""
+    def __init__(self, per_min: float, burst: float):
+        self.rate, self.burst = per_min / 60.0, max(1.0, burst)
+        self.db = open_db()
+        self.lock = threading.Lock()
+        self.db.execute("CREATE TABLE IF NOT EXISTS rate_limits (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)")
+
+    def hit(self, key: str) -> float:
+        now = time.time()
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.db.execute("SELECT tokens, updated FROM rate_limits WHERE key = ?", (key,)).fetchone()
+                tokens, wait = _bucket_take(*(row or (self.burst, now)), now, self.rate, self.burst)
+                self.db.execute("INSERT OR REPLACE INTO rate_limits(key, tokens, updated) VALUES (?, ?, ?)", (key, tokens, now))
+                if random.random() < 0.001:   # изредка чистим давно полные бакеты
+                    self.db.execute("DELETE FROM rate_limits WHERE updated < ?", (now - self.burst / self.rate - 60,))
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+        return wait
+
+    async def take(self, keys: list[str]) -> float:
+        # BEGIN IMMEDIATE под конкуренцией воркеров ждёт до busy timeout — не на event loop
+        return await asyncio.to_thread(lambda: max(self.hit(k) for k in keys))
+
+def make_rate_limiter(per_min: float, burst: float):
+    if RATE_LIMIT_BACKEND == "sqlite":
+        return SQLiteRateLimiter(per_min, burst)
+    return MemoryRateLimiter(per_min, burst)
+
+submit_limiter = make_rate_limiter(SUBMIT_RATE_PER_MIN, SUBMIT_BURST)
+
+def client_ip(request: Request) -> str:
+    if TRUST_PROXY_HEADERS:
+        # левые записи пишет сам клиент; верить можно только той, что добавил наш N-й прокси справа
+        hops = [h.strip() for h in (request.headers.get("x-forwarded-for") or "").split(",") if h.strip()]
+        if len(hops) >= TRUST_PROXY_HEADERS:
+            return hops[-TRUST_PROXY_HEADERS]
+    return request.client.host if request.client else "unknown"
+
+async def admit(request: Request, user_id: Optional[int] = None) -> Optional[JSONResponse]:
+    """None — пропускаем; иначе готовый 429 с Retry-After. Без user_id — бакет IP (до проверки подписи
+    и разбора тела), с ним — бакет пользователя Telegram (после проверки initData)."""
+    keys = [f"tg:{user_id}"] if user_id else [f"ip:{client_ip(request)}"]
+    try:
+        wait = await submit_limiter.take(keys)
+    except Exception as e:
+        log.warning("rate limiter failed, letting request through: %s", e)
+        return None
+    if wait <= 0:
+        return None
+    log_event("rate_limited", level=logging.WARNING, path=request.url.path, keys=",".join(keys))
+    return JSONResponse({"ok": False, "error": "rate_limited"}, status_code=429,
+                        headers={"Retry-After": str(max(1, math.ceil(wait)))})
+
+# --- чтение тела с ограничением размера ---
+def json_loads(raw: bytes):
+    return orjson.loads(raw) if orjson is not None else json.loads(raw)
+
+async def read_body_capped(request: Request, limit: int) -> bytes:
+    """Читает тело потоком и обрывает на limit байт (413) — большой запрос не разбирается и не буферизуется целиком."""
+    declared = request.headers.get("content-length")
+    if declared is not None:
+        try:
+            too_big = int(declared) > limit
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Bad Content-Length")
+        if too_big:
+            raise HTTPException(status_code=413, detail="Request body too large")
+    chunks, size = [], 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > limit:
+            raise HTTPException(status_code=413, detail="Request body too large")
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+# Приём квиза по HTTP — и из Mini App (с подписанным initData), и из браузера. ТОЛЬКО в группу
 @app.post("/webapp/submit")
-async def webapp_submit(payload: dict = Body(...)):
+async def webapp_submit(request: Request):
+    # лимит по IP — раньше HMAC: мусорный initData тоже тратит бакет, а не только CPU
+    limited = await admit(request)
+    if limited is not None:
+        return limited
+    init_data = request.headers.get("X-Telegram-Init-Data") or ""
+    tg_user = verify_webapp_init_data(init_data) if init_data else None
+    if init_data and tg_user is None:
+        # чаще всего просто истёк WEBAPP_INITDATA_MAX_AGE_SEC; без заголовка лид и так принимается
+        # анонимно, так что 403 никого не остановит, а заявку живого пользователя потеряет
+        log_event("webapp_bad_init_data", level=logging.WARNING, ip=client_ip(request))
+    if tg_user:
+        limited = await admit(request, tg_user["id"])
+        if limited is not None:
+            return limited
+    try:
+        body = await read_body_capped(request, WEBAPP_MAX_BODY)
+    except HTTPException as e:
+        return JSONResponse({"ok": False, "error": "too_large" if e.status_code == 413 else "bad_request"},
+                            status_code=e.status_code)
+    try:
+        payload = json_loads(body)
+    except Exception:
+        return JSONResponse({"ok": False, "error": "bad_json"}, status_code=400)
+    if not isinstance(payload, dict):
+        return JSONResponse({"ok": False, "error": "bad_json"}, status_code=400)
+
     comp    = (payload.get("company") or "").strip()[:20000]
     task    = (payload.get("task") or "").strip()[:20000]
     contact = (payload.get("contact") or "").strip()[:500]
 
-    ok, err = validate_web_quiz(comp, task, contact)
-    if not ok:
+    ct, err = validate_web_quiz(comp, task, contact)
+    if ct is None:
         return JSONResponse({"ok": False, "error": err}, status_code=400)
 
-    txt = build_lead("WebApp/браузер", None, comp, task, contact)
-    delivered = await _send_to_leads(txt)
-    if not delivered:
+    dedup_key = LeadDedup.key(payload.get("nonce"), comp, task, ct.value)
+    if not await LeadDedup.claim(dedup_key):
+        log_event("lead_duplicate", source="webapp_submit")
+        return {"ok": True, "duplicate": True}
+    db.incr("webquiz")
+
+    if tg_user:
+        txt = build_lead("WebApp", None, comp, task, ct, sender_html=ufmt_webapp(tg_user))
+    else:
+        txt = build_lead("WebApp/браузер", None, comp, task, ct)
+    if not await Outbox.put(txt, "webapp"):
+        await LeadDedup.release(dedup_key)
         if ADMIN_CHAT_ID:
-            await notify_admin("⚠️ Лид-чат недоступен, проверьте окружение/права.")
+            await notify_admin("⚠️ Очередь лидов недоступна, проверьте диск/окружение.")
         return JSONResponse({"ok": False, "error": "leads_unavailable"}, status_code=503)
     return {"ok": True}
 
 # статика WebApp (если есть папка webapp)
 STATIC_ROOT = os.path.join(os.path.dirname(__file__), "webapp")
-if os.path.isdir(STATIC_ROOT):
-    app.mount("/webapp", StaticFiles(directory=STATIC_ROOT, html=True), name="webapp")
 
 # fallback HTML /webapp/quiz (клиентская валидация и запрет кнопки при пустых полях)
 FALLBACK_QUIZ_HTML = """<!doctype html>
@@ -1178,18 +3206,21 @@ button#send[disabled]{opacity:.4;cursor:not-allowed}
       nonce: Math.random().toString(36).slice(2) + Date.now()  // для антидублей на сервере
     };
 
-    // 1) Пытаемся отдать данные в Telegram (если это WebApp)
+    // Mini App: сервер проверит подпись initData и сам припишет лид пользователю — sendData не нужен.
+    // sendData — только если initData нет (старый клиент/кнопка клавиатуры); сервер склеит дубль по nonce.
+    const initData = (tg && tg.initData) || "";
     try{
-      if (tg && tg.sendData) {
+      if (!initData && tg && tg.sendData) {
         tg.sendData(JSON.stringify(payload));
       }
     }catch(e){ console.log("tg.sendData failed:", e); }
 
-    // 2) Всегда бэкапим на сервер (уйдёт в лид-группу через /webapp/submit)
     try{
+      const headers = {'Content-Type':'application/json','X-From-WebApp':'1'};
+      if (initData) headers['X-Telegram-Init-Data'] = initData;
       const r = await fetch('/webapp/submit', {
         method:'POST',
-        headers:{'Content-Type':'application/json','X-From-WebApp':'1'},
+        headers,
         body: JSON.stringify(payload)
       });
       if(!r.ok){
@@ -1198,10 +3229,9 @@ button#send[disabled]{opacity:.4;cursor:not-allowed}
       }
       document.querySelector('.card').innerHTML =
         '<h3>Ваша анкета отправлена, спасибо! ✅</h3><p>Мы свяжемся с вами в ближайшее время.</p>';
+      if (tg && tg.close) tg.close();   // только после успеха — при ошибке форма остаётся для повтора
     }catch(e){
       alert(e.message||e);
-    }finally{
-      if (tg && tg.close) tg.close();
     }
   }
 
@@ -1213,22 +3243,129 @@ button#send[disabled]{opacity:.4;cursor:not-allowed}
 </body></html>"""
 
 
+# ---------- STATIC (квиз WebApp из памяти) ----------
+class StaticAssets:
+    """webapp/quiz/* (или FALLBACK_QUIZ_HTML) лежат в памяти вместе с gzip/br-вариантами.
+    CSS/JS/картинки отдаются ещё и по адресу с хэшем содержимого (style.<hash>.css, immutable на год),
+    ссылки на них в index.html переписываются; сам index.html — no-cache + ETag, повторное открытие → 304.
+    При STATIC_RELOAD=1 (dev) изменения файлов подхватываются без рестарта."""
+    QUIZ_DIR = os.path.join(STATIC_ROOT, "quiz")
+    URL = "/webapp/quiz/"
+    IMMUTABLE = "public, max-age=31536000, immutable"
+    REVALIDATE = "no-cache"
+    MIN_COMPRESS = 256        # мельче — сжатие не окупает заголовков
+    RELOAD_CHECK_SEC = 1.0
+    _assets: dict = {}        # имя в /webapp/quiz/ ("" — index) -> StaticAsset
+    _sig = None
+    _checked = 0.0
+
+    @classmethod
+    def _signature(cls) -> tuple:
+        try:
+            with os.scandir(cls.QUIZ_DIR) as it:
+                return tuple(sorted((e.name, e.stat().st_mtime_ns, e.stat().st_size) for e in it if e.is_file()))
+        except OSError:
+            return ()
+
+    @classmethod
+    def _build(cls, body: bytes, ctype: str, cache: str) -> StaticAsset:
+        h = hashlib.sha256(body).hexdigest()[:16]
+        variants = {"identity": body}
+        if len(body) >= cls.MIN_COMPRESS and not ctype.startswith(("image/", "font/woff")):
+            gz = gzip.compress(body, compresslevel=9, mtime=0)
+            if len(gz) < len(body):
+                variants["gzip"] = gz
+            if brotli is not None:
+                br = brotli.compress(body, quality=11)
+                if len(br) < len(body):
+                    variants["br"] = br
+        return StaticAsset(ctype, h, cache, variants)
+
+    @classmethod
+    def load(cls) -> None:
+        sig = cls._signature()
+        assets: dict = {}
+        hashed: dict = {}         # исходное имя -> имя с хэшем
+        index = None
+        for name, _mtime, _size in sig:
+            path = os.path.join(cls.QUIZ_DIR, name)
+            try:
+                with open(path, "rb") as f:
+                    body = f.read()
+            except OSError as e:
+                log.warning("static %s: %s", name, e)
+                continue
+            if name == "index.html":
+                index = body
+                continue
+            ctype = mimetypes.guess_type(name)[0] or "application/octet-stream"
+            if ctype.startswith("text/") or ctype == "application/javascript":
+                ctype += "; charset=utf-8"
+            a = cls._build(body, ctype, cls.IMMUTABLE)
+            stem, ext = os.path.splitext(name)
+            hashed[name] = f"{stem}.{a.etag[:10]}{ext}"
+            assets[hashed[name]] = a
+            assets[name] = a._replace(cache=cls.REVALIDATE)      # старые ссылки без хэша продолжают работать
+        if index is None:
+            index = FALLBACK_QUIZ_HTML.encode("utf-8")
+        else:
+            html_text = index.decode("utf-8")
+            for name, url in hashed.items():
+                html_text = re.sub(r'((?:src|href)=["\'])(?:\./|' + re.escape(cls.URL) + ')?' + re.escape(name) + r'(?=["\'])',
+                                   lambda m, url=url: m.group(1) + cls.URL + url, html_text)
+            index = html_text.encode("utf-8")
+        assets[""] = cls._build(index, "text/html; charset=utf-8", cls.REVALIDATE)
+        cls._assets, cls._sig = assets, sig
+        cls._checked = time.monotonic()
+        log.info("static: %d quiz assets in memory (brotli=%s)", len(assets), brotli is not None)
+
+    @classmethod
+    def _maybe_reload(cls) -> None:
+        if cls._sig is None:
+            cls.load()
+            return
+        if not STATIC_RELOAD:
+            return
+        now = time.monotonic()
+        if now - cls._checked < cls.RELOAD_CHECK_SEC:
+            return
+        cls._checked = now
+        if cls._signature() != cls._sig:
+            cls.load()
+
+    @classmethod
+    def response(cls, request: Request, name: str) -> Response:
+        cls._maybe_reload()
+        return serve_asset(request, cls._assets.get(name))
+
+
 @app.get("/webapp/quiz", response_class=HTMLResponse)
 @app.get("/webapp/quiz/", response_class=HTMLResponse)
-async def webapp_quiz():
-    index_path = os.path.join(STATIC_ROOT, "quiz", "index.html")
-    if os.path.exists(index_path):
-        return FileResponse(index_path, media_type="text/html")
-    return HTMLResponse(FALLBACK_QUIZ_HTML)
+async def webapp_quiz(request: Request):
+    return StaticAssets.response(request, "")
+
+@app.get("/webapp/quiz/{name}", include_in_schema=False)
+async def webapp_quiz_asset(name: str, request: Request):
+    return StaticAssets.response(request, "" if name == "index.html" else name)
+
+if os.path.isdir(STATIC_ROOT):
+    # остальное в webapp/ — как раньше, с диска (квиз выше перехватывают маршруты из памяти)
+    app.mount("/webapp", StaticFiles(directory=STATIC_ROOT, html=True), name="webapp")
 
-# фавикон
+# фавикон и производные картинки (AssetVariants)
 @app.get("/favicon.ico", include_in_schema=False)
-async def favicon():
-    hero = os.path.join(os.path.dirname(__file__), "assets", "hero.png")
-    if os.path.exists(hero):
-        return FileResponse(hero, media_type="image/png")
+async def favicon(request: Request):
+    a = AssetVariants.get("favicon.ico")
+    if a is not None:
+        return serve_asset(request, a)
+    if os.path.exists(AssetVariants.SRC):   # нет Pillow или ещё строится — как раньше, но пусть браузер кэширует
+        return FileResponse(AssetVariants.SRC, media_type="image/png", headers={"Cache-Control": "public, max-age=86400"})
     return Response(status_code=204)
 
+@app.get("/assets/{name}", include_in_schema=False)
+async def asset_variant(name: str, request: Request):
+    return serve_asset(request, AssetVariants.get(name))
+
 # HEAD-хендлеры
 @app.head("/")
 async def head_root(): return Response(status_code=200)
@@ -1240,16 +3377,150 @@ async def index(): return f"<h3>{esc(BRAND_NAME)} — {esc(BRAND_TAGLINE)}</h3>"
 @app.get("/healthz", response_class=PlainTextResponse)
 async def healthz(): return "ok"
 
+# --- очередь апдейтов (ack-first): webhook отвечает сразу, хендлеры крутят воркеры ---
+def _event_type(update: Update) -> str:
+    """event_type без исключения: для типа апдейта, которого aiogram ещё не знает, — "unknown"
+    (иначе webhook ответит 500, и Telegram будет повторять этот апдейт, застопорив доставку)."""
+    try:
+        return update.event_type
+    except UpdateTypeLookupError:
+        return "unknown"
+
+def _update_key(update: Update) -> int:
+    """Ключ шардирования: пользователь (или чат) — апдейты одного человека идут по порядку."""
+    try:
+        ev = update.event
+    except UpdateTypeLookupError:   # неизвестный aiogram тип апдейта — шард по update_id
+        return update.update_id
+    user = getattr(ev, "from_user", None)
+    if user is not None:
+        return user.id
+    chat = getattr(ev, "chat", None) or getattr(getattr(ev, "message", None), "chat", None)
+    return chat.id if chat is not None else update.update_id
+
+class UpdatePipeline:
+    """N воркеров, у каждого своя ограниченная очередь; апдейт попадает в очередь по _update_key,
+    поэтому порядок внутри одного чата сохраняется, а разные чаты обрабатываются параллельно."""
+    def __init__(self, workers: int, size: int):
+        self.n = max(1, workers)
+        self.size = max(1, size // self.n)
+        self.queues: list[asyncio.Queue] = []
+        self.tasks: list[asyncio.Task] = []
+        self.accepting = False
+
+    def start(self) -> None:
+        if self.tasks:
+            return
+        self.queues = [asyncio.Queue(maxsize=self.size) for _ in range(self.n)]
+        self.tasks = [asyncio.create_task(self._worker(q)) for q in self.queues]
+        self.accepting = True
+        log.info("Update pipeline started: workers=%s, queue=%s each", self.n, self.size)
+
+    def depth(self) -> int:
+        return sum(q.qsize() for q in self.queues)
+
+    def offer(self, update: Update) -> bool:
+        """Кладёт апдейт без ожидания. False — очередь полна или идёт остановка."""
+        if not self.accepting:
+            return False
+        try:
+            self.queues[_update_key(update) % self.n].put_nowait(update)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    async def _worker(self, q: asyncio.Queue) -> None:
+        while True:
+            update = await q.get()
+            try:
+                await dp.feed_update(bot, update)
+            except Exception as e:
+                log.exception("Update %s failed: %s", update.update_id, e)
+            finally:
+                q.task_done()
+
+    async def drain(self, timeout: float) -> None:
+        """Перестаёт принимать, дорабатывает очередь (не дольше timeout) и гасит воркеров."""
+        self.accepting = False
+        if not self.tasks:
+            return
+        try:
+            await asyncio.wait_for(asyncio.gather(*(q.join() for q in self.queues)), timeout=timeout)
+        except asyncio.TimeoutError:
+            log.warning("Update pipeline drain timeout: %s updates dropped", self.depth())
+        for t in self.tasks:
+            t.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+updates = UpdatePipeline(WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE)
+
+async def catch_up_backlog() -> dict:
+    """Дочитывает накопившиеся за простой апдейты через getUpdates (вебхук должен быть снят).
+    Чаты обрабатываются параллельно (до CATCHUP_CONCURRENCY), апдейты одного чата — по порядку.
+    Не уложились в CATCHUP_MAX_UPDATES/CATCHUP_MAX_SEC — хвост не теряется, его доставит вебхук."""
+    t0 = time.perf_counter()
+    deadline = time.monotonic() + CATCHUP_MAX_SEC
+    sem = asyncio.Semaphore(max(1, CATCHUP_CONCURRENCY))
+    offset: Optional[int] = None
+    total = failed = 0
+    chats: set = set()
+
+    async def run_chat(items: list[Update]) -> None:
+        nonlocal failed
+        async with sem:
+            for u in items:
+                try:
+                    await dp.feed_update(bot, u)
+                except Exception as e:
+                    failed += 1
+                    log.warning("catch-up update %s failed: %s", u.update_id, e)
+
+    while total < CATCHUP_MAX_UPDATES and time.monotonic() < deadline:
+        batch = await bot.get_updates(offset=offset, limit=min(100, CATCHUP_MAX_UPDATES - total), timeout=0)
+        if not batch:
+            break
+        offset = batch[-1].update_id + 1
+        groups: dict = {}
+        for u in batch:
+            groups.setdefault(_update_key(u), []).append(u)
+        chats.update(groups)
+        await asyncio.gather(*(run_chat(g) for g in groups.values()))
+        total += len(batch)
+    if offset is not None:
+        await bot.get_updates(offset=offset, limit=1, timeout=0)   # подтвердить обработанное, иначе придут повторно
+    report = {"recovered": total, "chats": len(chats), "failed": failed,
+              "sec": round(time.perf_counter() - t0, 2)}
+    log_event("backlog_catchup", **report)
+    return report
+
+Metrics.gauge("vimly_leads_queue_depth", "Leads waiting in the outbox", Outbox.depth)
+Metrics.gauge("vimly_leads_delivered", "Leads delivered by the outbox since start", lambda: Outbox.sent)
+Metrics.gauge("vimly_leads_failed_attempts", "Failed outbox delivery attempts since start", lambda: Outbox.failed_attempts)
+Metrics.gauge("vimly_leads_dead", "Leads moved to the outbox dead-letter", Outbox.dead_count)
+Metrics.gauge("vimly_update_queue_depth", "Webhook updates waiting for a worker", updates.depth)
+Metrics.gauge("vimly_reminders_scheduled", "Promo reminders in the scheduler", lambda: len(reminders))
+Metrics.gauge("vimly_sender", "Outbound dispatcher counters", sender.stats)
+Metrics.gauge("vimly_events", "Business counters (starts, quiz, orders, …)", db.stats)
+
 @app.post(WEBHOOK_PATH)
 async def webhook(request: Request):
-    # временный лог
-    log.info("Webhook headers: %r", dict(request.headers))
     if WEBHOOK_SECRET:
         secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token")
         if secret != WEBHOOK_SECRET:
             raise HTTPException(status_code=403, detail="Invalid secret token")
-    data = await request.json()
-    update = Update.model_validate(data)
+    body = await read_body_capped(request, WEBHOOK_MAX_BODY)
+    try:
+        # pydantic разбирает JSON сам (Rust) — без промежуточного dict
+        update = Update.model_validate_json(body)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Bad update payload")
+    log_event("webhook_update", update_id=update.update_id, type=_event_type(update))
+    if WEBHOOK_ACK_FIRST:
+        if not updates.offer(update):
+            # Telegram повторит доставку позже — это и есть backpressure
+            raise HTTPException(status_code=503, detail="Update queue is full")
+        return {"ok": True}
     await dp.feed_update(bot, update)
     return {"ok": True}
 
@@ -1257,10 +3528,96 @@ async def webhook(request: Request):
 # --- Error handler: aiogram 3.16+ ---
 from aiogram.types.error_event import ErrorEvent  # <-- новый импорт
 
+# ---------- ERRORS (агрегация) ----------
+class ErrorReports:
+    """Ошибки хендлеров группируются по отпечатку (тип + верхний кадр в app.py). Первая в окне — сразу админу,
+    повторы только считаются; по истечении ERROR_REPORT_WINDOW_SEC — одна сводка «×N» с примером пользователя.
+    Так шторм (лёг лид-чат, 5xx от Telegram) не умножает исходящие запросы на число апдейтов.
+    Счётчики — на процесс; их видно в админ-панели."""
+    _open: dict = {}          # отпечаток -> {"where", "count", "sample", "last", "task"} текущего окна
+    _totals: dict = {}        # отпечаток -> ошибок за всё время работы процесса
+    reports = 0               # сколько сообщений админу ушло
+    suppressed = 0            # сколько ошибок свёрнуто в сводки
+
+    @staticmethod
+    def fingerprint(exc: BaseException) -> str:
+        frames = traceback.extract_tb(exc.__traceback__) if exc.__traceback__ else []
+        ours = [f for f in frames if f.filename == __file__]
+        top = (ours or frames or [None])[-1]
+        where = f"{top.name}:{top.lineno}" if top is not None else "?"
+        return f"{type(exc).__name__}@{where}"
+
+    @classmethod
+    def record(cls, exc: BaseException, who: Optional[str]) -> Optional[str]:
+        """Учитывает ошибку; возвращает текст для админа, если это первая в окне, иначе None."""
+        fp = cls.fingerprint(exc)
+        cls._totals[fp] = cls._totals.get(fp, 0) + 1
+        e = cls._open.get(fp) if ERROR_REPORT_WINDOW_SEC > 0 else {}   # 0 — без агрегации, как раньше
+        if e:
+            e["count"] += 1
+            e["last"] = repr(exc)
+            e["sample"] = who or e["sample"]
+            cls.suppressed += 1
+            return None
+        if ERROR_REPORT_WINDOW_SEC > 0:
+            cls._open[fp] = e = {"count": 0, "sample": who, "last": repr(exc), "task": None}
+            e["task"] = asyncio.create_task(cls._window(fp))
+        text = f"⚠️ Ошибка бота <code>{esc(fp)}</code>"
+        if who:
+            text += f" (от {who})"
+        text += f":\n<code>{esc(cut_text(repr(exc), 1000))}</code>"
+        if ERROR_REPORT_WINDOW_SEC > 0:
+            text += f"\nПовторы в ближайшие {int(ERROR_REPORT_WINDOW_SEC)} с придут одной сводкой."
+        return text
+
+    @classmethod
+    async def _window(cls, fp: str) -> None:
+        # пока ошибка повторяется — раз в окно сводка; тихое окно закрывает отпечаток
+        while True:
+            await asyncio.sleep(ERROR_REPORT_WINDOW_SEC)
+            e = cls._open.get(fp)
+            if e is None or not e["count"]:
+                cls._open.pop(fp, None)
+                return
+            n, e["count"] = e["count"], 0
+            text = (f"⚠️ <code>{esc(fp)}</code> ×{n} за {int(ERROR_REPORT_WINDOW_SEC)} с"
+                    f" (всего {cls._totals.get(fp, 0)})")
+            if e["sample"]:
+                text += f"\nНапример, у {e['sample']}"
+            text += f":\n<code>{esc(cut_text(e['last'], 1000))}</code>"
+            await cls.send(text)
+
+    @classmethod
+    async def send(cls, text: str) -> None:
+        """Тихо админу; reports считает только реально ушедшие сообщения."""
+        if not ADMIN_CHAT_ID:
+            return
+        try:
+            await bot.send_message(ADMIN_CHAT_ID, text, disable_notification=True)
+        except Exception as e:
+            log.warning("error report failed: %s", e)
+            return
+        cls.reports += 1
+
+    @classmethod
+    def stats(cls, top: int = 3) -> dict:
+        worst = sorted(cls._totals.items(), key=lambda kv: kv[1], reverse=True)[:top]
+        return {"total": sum(cls._totals.values()), "kinds": len(cls._totals), "active": len(cls._open),
+                "reports": cls.reports, "suppressed": cls.suppressed, "top": worst}
+
+    @classmethod
+    def stop(cls) -> None:
+        for e in cls._open.values():
+            if e["task"] is not None:
+                e["task"].cancel()
+        cls._open.clear()
+
+
 @dp.errors()
 async def on_error(event: ErrorEvent):
     # аккуратно достанем исключение и контекст
     exc = event.exception
+    first = True
     try:
         who = None
         # если это ошибка из message/callback — попробуем подписать отправителя
@@ -1272,92 +3629,329 @@ async def on_error(event: ErrorEvent):
             u = obj.callback_query.from_user
             who = f"{u.full_name} (@{u.username or '—'}, id={u.id})"
 
-        text = "⚠️ Ошибка бота"
-        if who:
-            text += f" (от {who})"
-        text += f":\n<code>{html.escape(repr(exc), quote=False)}</code>"
-
-        # уведомим админа тихо
-        if ADMIN_CHAT_ID:
-            try:
-                await bot.send_message(ADMIN_CHAT_ID, text, disable_notification=True)
-            except Exception:
-                pass
+        text = ErrorReports.record(exc, who)
+        first = text is not None
+        # уведомим админа — только о первой в окне, повторы уйдут сводкой
+        if first:
+            await ErrorReports.send(text)
     finally:
-        # и обязательно залогируем с трейсбеком
-        logging.exception("Handler error: %s", exc)
+        # и обязательно залогируем: трейсбек — для первой в окне, повторы одной строкой
+        if first:
+            log.error("Handler error: %s", exc, exc_info=exc)
+        else:
+            log.warning("Handler error (repeat %s): %r", ErrorReports.fingerprint(exc), exc)
+
+# ---------- LEADER ----------
+class Leader:
+    """Выбор одного воркера под побочные эффекты: set_webhook, стартовые DM админу, напоминания.
+    Аренда — строка в общей SQLite: лидер продлевает её каждые LEADER_LEASE_SEC/3,
+    упавший лидер перестаёт продлевать, и через LEADER_LEASE_SEC роль забирает другой воркер."""
+    NAME = "main"
+    owner = f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(3)}"
+    is_leader = False
+    _db: Optional[sqlite3.Connection] = None
+    _lock = threading.Lock()
+    _task: Optional[asyncio.Task] = None
+    _on_gain = None
+    _on_lose = None
+
+    @classmethod
+    def _acquire(cls) -> bool:
+        """Взять или продлить аренду. Атомарно: чужая живая аренда не перезаписывается."""
+        now = time.time()
+        with cls._lock:
+            if cls._db is None:
+                cls._db = open_db()
+                cls._db.execute("CREATE TABLE IF NOT EXISTS leader (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)")
+            cls._db.execute(
+                "INSERT INTO leader(name, owner, expires_at) VALUES (?, ?, ?)"
+                " ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at"
+                " WHERE leader.owner = excluded.owner OR leader.expires_at < ?",
+                (cls.NAME, cls.owner, now + LEADER_LEASE_SEC, now),
+            )
+            row = cls._db.execute("SELECT owner FROM leader WHERE name = ?", (cls.NAME,)).fetchone()
+        return bool(row) and row[0] == cls.owner
+
+    @classmethod
+    def _release(cls) -> None:
+        with cls._lock:
+            if cls._db is not None:
+                cls._db.execute("DELETE FROM leader WHERE name = ? AND owner = ?", (cls.NAME, cls.owner))
+
+    @classmethod
+    async def _tick(cls) -> None:
+        try:
+            leader = await asyncio.to_thread(cls._acquire)
+        except Exception as e:
+            log.warning("leader lease check failed: %s", e)
+            leader = False      # не уверены — уступаем, лучше без напоминаний, чем дубли
+        if leader == cls.is_leader:
+            return
+        cls.is_leader = leader
+        log_event("leader_changed", leader=leader, owner=cls.owner)
+        cb = cls._on_gain if leader else cls._on_lose
+        if cb is not None:
+            try:
+                await cb()
+            except Exception as e:
+                log.exception("leader %s callback failed: %s", "gain" if leader else "lose", e)
+
+    @classmethod
+    async def _loop(cls) -> None:
+        while True:
+            await asyncio.sleep(LEADER_LEASE_SEC / 3)
+            await cls._tick()
+
+    @classmethod
+    async def start(cls, on_gain=None, on_lose=None) -> bool:
+        """Первая попытка — сразу (чтобы startup знал, лидер ли он), дальше — в фоне."""
+        cls._on_gain, cls._on_lose = on_gain, on_lose
+        await cls._tick()
+        if cls._task is None:
+            cls._task = asyncio.create_task(cls._loop())
+        return cls.is_leader
+
+    @classmethod
+    async def stop(cls) -> None:
+        if cls._task is not None:
+            cls._task.cancel()
+            await asyncio.gather(cls._task, return_exceptions=True)
+            cls._task = None
+        if cls.is_leader:
+            cls.is_leader = False
+            if cls._on_lose is not None:
+                await cls._on_lose()
+            await asyncio.to_thread(cls._release)   # следующий воркер не ждёт истечения аренды
+
+async def _leader_duties_start() -> None:
+    if getattr(app.state, "promo_task", None) is None:
+        app.state.promo_task = asyncio.create_task(promo_reminder_loop())
+
+async def _leader_duties_stop() -> None:
+    task = getattr(app.state, "promo_task", None)
+    app.state.promo_task = None
+    if task:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+    reminders.clear()   # расписание теперь ведёт новый лидер; при возврате лидерства load() поднимет его из БД
+
+async def _startup_alert(text: str) -> None:
+    """DM админу о проблеме при старте — только от лидера и не чаще раза в STARTUP_CACHE_TTL_SEC
+    на одинаковый текст (частые cold start'ы не должны спамить одним и тем же)."""
+    if not (ADMIN_CHAT_ID and Leader.is_leader):
+        return
+    key = "startup_alert:" + hashlib.sha1(text.encode()).hexdigest()[:12]
+    last = db.get_meta(key)
+    if last and time.time() - float(last) < STARTUP_CACHE_TTL_SEC:
+        return
+    try:
+        await bot.send_message(ADMIN_CHAT_ID, text)
+        db.set_meta(key, str(time.time()))
+    except Exception:
+        pass
+
+async def _verify_lead_chat(chat_id, bot_id: int) -> None:
+    """Бот состоит в лид-чате и может писать; заодно прогревает LeadsChatCache (is_forum/title)."""
+    cm = await bot.get_chat_member(chat_id, bot_id)
+    no_send = (getattr(cm, "status", None) in {"left", "kicked"})
+    if hasattr(cm, "can_send_messages"):
+        no_send = no_send or (not getattr(cm, "can_send_messages"))
+    if no_send:
+        raise TelegramForbiddenError("Bot has no send rights")
+    try:
+        await LeadsChatCache.refresh(chat_id)
+    except Exception as e:
+        log.warning("get_chat for leads cache failed (%r): %s", chat_id, e)
+
+# ---------- STARTUP CHECKS (параллельно, с кэшем результатов в meta) ----------
+async def _refresh_identity() -> None:
+    global BOT_USERNAME
+    me = await bot.get_me()
+    BOT_USERNAME = me.username or BOT_USERNAME
+    db.set_meta("bot_me", json.dumps({"id": me.id, "username": me.username}))
+
+def _lead_chats() -> list:
+    return list(dict.fromkeys(t.chat for t in LeadRouter.targets()))
+
+def _leads_verified_recently() -> bool:
+    """Прошлая успешная проверка тех же лид-чатов свежее STARTUP_CACHE_TTL_SEC."""
+    try:
+        cached = json.loads(db.get_meta("leads_verified") or "null")
+    except ValueError:
+        return False
+    return (isinstance(cached, dict) and cached.get("chats") == [str(c) for c in _lead_chats()]
+            and time.time() - cached.get("at", 0) < STARTUP_CACHE_TTL_SEC)
+
+async def _check_lead_chats() -> None:
+    """Бот может писать во все лид-чаты маршрутов; иначе приём заявок отключается."""
+    chats = _lead_chats()
+    # bot.id берётся из токена — get_me ждать не нужно
+    results = await asyncio.gather(*(_verify_lead_chat(c, bot.id) for c in chats), return_exceptions=True)
+    ok = True
+    for chat_id, e in zip(chats, results):
+        if isinstance(e, TelegramForbiddenError):
+            ok = False
+            log.critical("Bot lacks permissions for leads chat %r: %s", chat_id, e)
+            await _startup_alert(f"⚠️ Бот не может писать в лид-чат <code>{esc(str(chat_id))}</code>. Приём заявок отключён.")
+        elif isinstance(e, Exception):
+            ok = False
+            log.critical("Failed to verify leads chat %r: %s", chat_id, e)
+            await _startup_alert(f"⚠️ Не удалось проверить лид-чат <code>{esc(str(chat_id))}</code>: <code>{esc(str(e))}</code>")
+    Store.accepting = ok
+    db.set_meta("leads_verified", json.dumps({"chats": [str(c) for c in chats], "at": time.time()}) if ok else None)
+
+async def _ensure_webhook() -> None:
+    """set_webhook только если Telegram знает другой URL или у нас сменился секрет.
+    Секрет из getWebhookInfo не виден, поэтому его отпечаток — в query самого URL (?v=…): сверка
+    идёт по ответу Telegram и не зависит от локальной БД (на Render free диск теряется при каждом засыпании)."""
+    if not BASE_URL:
+        log.warning("BASE_URL is not set; webhook not configured")
+        return
+    base = f"{BASE_URL}{WEBHOOK_PATH}"
+    sig = hashlib.sha256(f"{base}\0{WEBHOOK_SECRET}".encode()).hexdigest()[:16]
+    url = f"{base}?v={sig}"
+    try:
+        info = await bot.get_webhook_info()
+        if info.url == url:
+            # накопленное за простой Telegram сам доставит на этот же вебхук
+            log.info("Webhook already set: %r (pending updates: %s)", url, info.pending_update_count)
+            return
+    except Exception as e:
+        log.warning("get_webhook_info failed: %s", e)
+    if CATCHUP_ON_START:
+        # вместо drop_pending_updates: снять вебхук, дочитать накопленное, потом включить
+        try:
+            await bot.delete_webhook(drop_pending_updates=False)
+            report = await catch_up_backlog()
+            if report["recovered"]:
+                await notify_admin(f"♻️ После простоя обработано апдейтов: {report['recovered']} "
+                                   f"({report['chats']} чатов) за {report['sec']} с")
+        except Exception as e:
+            log.warning("backlog catch-up failed: %s", e)
+    log.info("Setting webhook to: %r", url)
+    try:
+        await bot.set_webhook(url=url, secret_token=WEBHOOK_SECRET or None, drop_pending_updates=not CATCHUP_ON_START)
+        log.info("Webhook set OK")
+    except Exception as e:
+        log.error("Failed to set webhook: %s", e)
+
+async def _startup_checks(phases: dict, t0: float, background: bool) -> None:
+    async def timed(name: str, coro) -> None:
+        t = time.perf_counter()
+        try:
+            await coro
+        except Exception as e:
+            log.warning("startup %s failed: %s", name, e)
+        finally:
+            phases[name] = round((time.perf_counter() - t) * 1000, 1)
+    jobs = [timed("get_me", _refresh_identity()), timed("leads_check", _check_lead_chats())]
+    if MODE == "webhook" and Leader.is_leader:
+        if background:
+            jobs.append(timed("webhook", _ensure_webhook()))
+        else:
+            # холодный старт ждёт только get_me и лид-чаты; вебхук с дочиткой backlog (до CATCHUP_MAX_SEC) — в фоне
+            app.state.webhook_task = asyncio.create_task(_ensure_webhook())
+    await asyncio.gather(*jobs)
+    if background:   # иначе фазы попадут в общий лог "startup"
+        log_event("startup_checks", total_ms=round((time.perf_counter() - t0) * 1000, 1), **phases)
 
 # ---------- LIFECYCLE ----------
 @app.on_event("startup")
 async def on_startup():
     global BOT_USERNAME
-    me = None
+    t0 = time.perf_counter()
+    phases: dict = {}
+    def mark(name: str, since: float) -> float:
+        now = time.perf_counter()
+        phases[name] = round((now - since) * 1000, 1)
+        return now
+
+    t = t0
+    await db.start()
+    if isinstance(fsm_storage, SQLiteFSMStorage):
+        await fsm_storage.start()
+    t = mark("state", t)
+    RenderCache.warm()
+    t = mark("render_warm", t)
+    StaticAssets.load()
+    t = mark("static", t)
+    # фавикон/hero: с дискового кэша — миллисекунды, первый прогон после новой картинки — в фоне
+    app.state.assets_task = asyncio.create_task(asyncio.to_thread(AssetVariants.build))
+    app.state.promo_task = None
     try:
-        me = await bot.get_me()
-        BOT_USERNAME = me.username or BOT_USERNAME
+        await Leader.start(_leader_duties_start, _leader_duties_stop)
     except Exception as e:
-        log.warning("get_me failed: %s", e)
+        log.error("leader election failed: %s", e)
+    t = mark("leader", t)
+    log.info("worker %s: %s (workers=%s)", Leader.owner, "leader" if Leader.is_leader else "follower", WEB_CONCURRENCY)
 
-    # Проверяем, что бот может писать в лид-чат; иначе отключаем приём заявок
-    target = parse_leads_target(LEADS_RAW)
-    if not target:
-        log.critical("LEADS_CHAT_ID invalid/empty: %r", LEADS_RAW)
-        Store.accepting = False
-        if ADMIN_CHAT_ID:
-            try:
-                await bot.send_message(ADMIN_CHAT_ID, "⚠️ LEADS_CHAT_ID invalid/empty. Приём заявок отключён.")
-            except Exception:
-                pass
-    else:
-        try:
-            if me is None:
-                me = await bot.get_me()
-            cm = await bot.get_chat_member(target, me.id)
-            no_send = (getattr(cm, "status", None) in {"left", "kicked"})
-            if hasattr(cm, "can_send_messages"):
-                no_send = no_send or (not getattr(cm, "can_send_messages"))
-            if no_send:
-                raise TelegramForbiddenError("Bot has no send rights")
-        except TelegramForbiddenError as e:
-            log.critical("Bot lacks permissions for LEADS_CHAT_ID %r: %s", LEADS_RAW, e)
-            Store.accepting = False
-            if ADMIN_CHAT_ID:
-                try:
-                    await bot.send_message(ADMIN_CHAT_ID, "⚠️ Бот не может писать в лид-чат. Приём заявок отключён.")
-                except Exception:
-                    pass
-        except Exception as e:
-            log.critical("Failed to verify LEADS_CHAT_ID %r: %s", LEADS_RAW, e)
-            Store.accepting = False
-            if ADMIN_CHAT_ID:
-                try:
-                    await bot.send_message(ADMIN_CHAT_ID, f"⚠️ Не удалось проверить лид-чат: <code>{esc(str(e))}</code>")
-                except Exception:
-                    pass
+    # тёплый рестарт: личность бота и права в лид-чатах — из прошлого запуска, проверки идут в фоне
+    LeadRouter.load()
+    try:
+        BOT_USERNAME = json.loads(db.get_meta("bot_me") or "{}").get("username") or BOT_USERNAME
+    except ValueError:
+        pass
+    warm = bool(BOT_USERNAME) and _leads_verified_recently()
 
     if MODE == "webhook":
-        if BASE_URL:
-            url = f"{BASE_URL}{WEBHOOK_PATH}"
-            log.info("Setting webhook to: %r", url)
-            try:
-                await bot.set_webhook(url=url, secret_token=WEBHOOK_SECRET or None, drop_pending_updates=True)
-                log.info("Webhook set OK")
-            except Exception as e:
-                log.error("Failed to set webhook: %s", e)
-        else:
-            log.warning("BASE_URL is not set; webhook not configured")
+        if WEBHOOK_ACK_FIRST:
+            updates.start()
+        if not Leader.is_leader:
+            log.info("Webhook is set by the leader worker")
     else:
         log.info("Polling mode — use __main__ launcher")
-            
-    # reminders
+
+    # очередь лидов
     try:
-        app.state.promo_task = asyncio.create_task(promo_reminder_loop())
+        Outbox.start()
     except Exception as e:
-        log.warning("Failed to start promo reminder loop: %s", e)
+        log.error("Failed to start leads outbox: %s", e)
+    t = mark("services", t)
+
+    if warm:
+        app.state.startup_checks = asyncio.create_task(_startup_checks(phases, t0, background=True))
+    else:
+        app.state.startup_checks = None
+        await _startup_checks(phases, t0, background=False)
+    log_event("startup", warm=warm, total_ms=round((time.perf_counter() - t0) * 1000, 1), **phases)
 
 
 @app.on_event("shutdown")
 async def on_shutdown():
+    # сначала доработать принятые апдейты — они ещё пишут в outbox/state
+    try:
+        await updates.drain(WEBHOOK_DRAIN_TIMEOUT_SEC)
+    except Exception as e:
+        log.warning("update pipeline drain failed: %s", e)
+
+    for name in ("startup_checks", "webhook_task"):
+        task = getattr(app.state, name, None)
+        if task is not None and not task.done():
+            task.cancel()
+
+    # остановить напоминания и отдать роль лидера другому воркеру
+    try:
+        await Leader.stop()
+    except Exception as e:
+        log.warning("leader stop failed: %s", e)
+
+    # stop outbox (недоставленное останется в SQLite до следующего старта)
+    try:
+        await Outbox.stop()
+    except Exception:
+        pass
+    ErrorReports.stop()
+
+    # дописать отложенные изменения состояния
+    try:
+        await db.close()
+    except Exception as e:
+        log.warning("state flush on shutdown failed: %s", e)
+    try:
+        await fsm_storage.close()
+    except Exception as e:
+        log.warning("FSM flush on shutdown failed: %s", e)
+
     try:
         await bot.session.close()
     except Exception:
@@ -1376,6 +3970,15 @@ async def on_shutdown():
 if __name__ == "__main__":
     async def _run():
         log.info("Starting polling...")
-        await bot.delete_webhook(drop_pending_updates=True)
-        await dp.start_polling(bot)
+        await db.start()
+        if isinstance(fsm_storage, SQLiteFSMStorage):
+            await fsm_storage.start()
+        Outbox.start()
+        await bot.delete_webhook(drop_pending_updates=not CATCHUP_ON_START)   # накопленное дочитает сам polling
+        try:
+            await dp.start_polling(bot)
+        finally:
+            await Outbox.stop()
+            await db.close()
+            await fsm_storage.close()
     asyncio.run(_run())
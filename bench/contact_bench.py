@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+Микробенчмарк разбора контакта: parse_contact() против прежней связки
+sanitize_phone() + valid_contact() (как было в order_contact_text).
+
+  python bench/contact_bench.py
+  python bench/contact_bench.py --number 200000
+"""
+
+import argparse, os, re, sys, tempfile, timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("BOT_TOKEN", "123456:BENCH-token-not-real")
+os.environ.setdefault("LEADS_CHAT_ID", "-1001000000001")
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="vimly-bench-"))
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+from app import parse_contact  # noqa: E402
+
+SAMPLES = [
+    "@vimly_client", "ivan.petrov@example.com", "+7 (999) 123-45-67", "8 999 123 45 67",
+    "89991234567", "тел. 8-912-000-11-22", "@abc", "просто текст", "", "user@host",
+]
+
+# --- как было: до трёх регулярок и двойная вырезка цифр ---
+USERNAME_RE = re.compile(r"^@[a-zA-Z0-9_]{5,}$")
+EMAIL_RE = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$")
+
+def sanitize_phone(s):
+    digits = re.sub(r"\D+", "", s or "")
+    return digits if 7 <= len(digits) <= 15 else None
+
+def valid_contact(s):
+    s = (s or "").strip()
+    if USERNAME_RE.match(s): return True
+    if EMAIL_RE.match(s): return True
+    d = re.sub(r"\D+", "", s)
+    return 7 <= len(d) <= 15
+
+def legacy(s):
+    s = (s or "").strip()
+    phone = sanitize_phone(s)
+    return phone if phone else (s if valid_contact(s) else None)
+
+
+def run(fn, number: int) -> float:
+    t = timeit.timeit(lambda: [fn(x) for x in SAMPLES], number=number)
+    return t / (number * len(SAMPLES)) * 1e9   # нс на контакт
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description="Микробенчмарк parse_contact")
+    p.add_argument("--number", type=int, default=50000)
+    args = p.parse_args()
+
+    for s in SAMPLES:
+        print(f"{s!r:<40} -> {parse_contact(s)}")
+    old = run(legacy, args.number)
+    new = run(parse_contact, args.number)
+    print(f"\nlegacy        {old:8.0f} ns/contact")
+    print(f"parse_contact {new:8.0f} ns/contact  ({old / new:.2f}x)")
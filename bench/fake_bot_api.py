@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Локальный стаб Telegram Bot API для нагрузочных прогонов (aiohttp).
+Бот ходит сюда через TELEGRAM_API_URL=http://127.0.0.1:<port> (aiogram TelegramAPIServer).
+
+Отвечает правдоподобными объектами на методы, которые зовёт app.py, с настраиваемой
+задержкой и долей 429 (retry_after). Считает вызовы по методам — по ним видно,
+сколько апдейтов реально дошло до хендлеров, а не только принято webhook'ом.
+
+Отдельно:  python bench/fake_bot_api.py --port 8081 --latency-ms 40 --rate-429 0.01
+"""
+
+import argparse, asyncio, itertools, json, random, time
+from collections import Counter
+from typing import Optional
+
+from aiohttp import web
+
+BOT_ID = 100500
+BOT_USER = {"id": BOT_ID, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+
+
+class FakeBotAPI:
+    def __init__(self, latency_ms: float = 0.0, jitter_ms: float = 0.0,
+                 rate_429: float = 0.0, retry_after: int = 1):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.calls: Counter = Counter()
+        self.throttled: Counter = Counter()
+        self.webhook_url = ""
+        self.backlog: list[dict] = []    # апдейты, «накопленные за простой» — отдаются через getUpdates
+        self._msg_ids = itertools.count(1)
+        self.app = web.Application()
+        self.app.router.add_route("*", "/bot{token}/{method}", self.handle)
+        self._runner: Optional[web.AppRunner] = None
+
+    # --- ответы ---
+    def _chat(self, chat_id) -> dict:
+        try:
+            cid = int(chat_id)
+        except (TypeError, ValueError):
+            cid = -1001000000001     # '@channel' и прочее — пусть будет супергруппа
+        return {"id": cid, "type": "private" if cid > 0 else "supergroup", "title": None if cid > 0 else "Leads"}
+
+    def _message(self, params: dict) -> dict:
+        chat = {k: v for k, v in self._chat(params.get("chat_id")).items() if v is not None}
+        return {"message_id": next(self._msg_ids), "date": int(time.time()), "chat": chat,
+                "from": BOT_USER, "text": params.get("text") or ""}
+
+    def result(self, method: str, params: dict):
+        m = method.lower()
+        if m == "getme":
+            return BOT_USER
+        if m in {"sendmessage", "editmessagetext", "editmessagereplymarkup", "forwardmessage"}:
+            return self._message(params)
+        if m in {"sendphoto", "senddocument"}:
+            msg = self._message(params)
+            fid = f"bench-{m}-{msg['message_id']}"
+            if m == "sendphoto":
+                msg["photo"] = [{"file_id": fid, "file_unique_id": fid, "width": 640, "height": 360}]
+            else:
+                msg["document"] = {"file_id": fid, "file_unique_id": fid}
+            return msg
+        if m == "getchatmember":
+            return {"status": "member", "user": BOT_USER}
+        if m == "getchat":
+            chat = {k: v for k, v in self._chat(params.get("chat_id")).items() if v is not None}
+            return {**chat, "accent_color_id": 0, "max_reaction_count": 11, "is_forum": False,
+                    "accepted_gift_types": {"unlimited_gifts": False, "limited_gifts": False, "unique_gifts": False,
+                                            "premium_subscription": False, "gifts_from_channels": False}}
+        if m == "getwebhookinfo":
+            return {"url": self.webhook_url, "has_custom_certificate": False,
+                    "pending_update_count": len(self.backlog)}
+        if m == "setwebhook":
+            self.webhook_url = params.get("url") or ""
+            return True
+        if m == "deletewebhook":
+            self.webhook_url = ""
+            return True
+        if m == "getupdates":
+            if self.webhook_url:
+                return []        # настоящий Bot API тут отвечает 409 Conflict
+            offset, limit = int(params.get("offset") or 0), int(params.get("limit") or 100)
+            self.backlog = [u for u in self.backlog if u["update_id"] >= offset]   # offset подтверждает прочитанное
+            return self.backlog[:limit]
+        # answerCallbackQuery, deleteMessage, sendChatAction и т.п.
+        return True
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = dict(await request.post()) if request.can_read_body else {}
+        params = {k: v for k, v in params.items() if isinstance(v, str)}   # файлы нам не нужны
+        self.calls[method] += 1
+        if self.latency_ms or self.jitter_ms:
+            await asyncio.sleep(max(0.0, self.latency_ms + random.uniform(-self.jitter_ms, self.jitter_ms)) / 1000)
+        if self.rate_429 and random.random() < self.rate_429:
+            self.throttled[method] += 1
+            return web.json_response({"ok": False, "error_code": 429,
+                                      "description": f"Too Many Requests: retry after {self.retry_after}",
+                                      "parameters": {"retry_after": self.retry_after}}, status=429)
+        return web.json_response({"ok": True, "result": self.result(method, params)})
+
+    # --- запуск ---
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> int:
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        return site._server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def snapshot(self) -> dict:
+        return {"calls": dict(self.calls), "throttled": dict(self.throttled)}
+
+
+async def _serve(args) -> None:
+    api = FakeBotAPI(args.latency_ms, args.jitter_ms, args.rate_429, args.retry_after)
+    port = await api.start(args.host, args.port)
+    print(f"fake Bot API on http://{args.host}:{port}  (latency={args.latency_ms}ms, 429={args.rate_429})")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        print(json.dumps(api.snapshot(), ensure_ascii=False, indent=2))
+        await api.stop()
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description="Стаб Telegram Bot API для нагрузочных тестов")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=8081)
+    p.add_argument("--latency-ms", type=float, default=0.0)
+    p.add_argument("--jitter-ms", type=float, default=0.0)
+    p.add_argument("--rate-429", type=float, default=0.0, help="доля ответов 429 (0..1)")
+    p.add_argument("--retry-after", type=int, default=1)
+    try:
+        asyncio.run(_serve(p.parse_args()))
+    except KeyboardInterrupt:
+        pass
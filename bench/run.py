@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+"""
+Нагрузочный прогон: поднимает app под uvicorn против локального стаба Bot API
+(bench/fake_bot_api.py) и гоняет синтетику:
+
+  start     — флуд /start от разных пользователей (webhook)
+  callback  — шторм нажатий по меню/тарифам (webhook)
+  quiz      — полный квиз-чат: go_quiz → ниша → цель → срок (по порядку на пользователя)
+  submit    — всплеск /webapp/submit с подписанным initData
+
+Меряем задержку ответа HTTP (p50/p95/p99) и пропускную способность, а также
+«сквозное» время — пока стаб не перестанет получать вызовы от бота (апдейты
+обрабатываются после 200 при WEBHOOK_ACK_FIRST). Результат — JSON в bench/results/,
+предыдущий прогон можно сравнить через --compare.
+
+  python bench/run.py
+  python bench/run.py --scenarios start,submit --requests 5000 --concurrency 200 --latency-ms 30
+  python bench/run.py --compare bench/results/<старый>.json --env WEBHOOK_WORKERS=16
+"""
+
+import argparse, asyncio, hashlib, hmac, itertools, json, os, platform, socket, subprocess, sys, tempfile, time
+from datetime import datetime, timezone
+from urllib.parse import urlencode
+
+import aiohttp
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_bot_api import FakeBotAPI  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BOT_TOKEN = "123456:BENCH-token-not-real"
+SECRET = "bench-secret"
+WEBHOOK_PATH = "/telegram/webhook/bench"
+LEADS_CHAT = "-1001000000001"
+SCENARIOS = ("start", "callback", "quiz", "submit")
+CALLBACKS = ("go_menu", "go_prices", "pkg_lite", "pkg_start", "pkg_pro", "pkg_ent", "go_process", "go_cases")
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def git_rev() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except Exception:
+        return "unknown"
+
+
+def quantile(xs: list[float], q: float) -> float:
+    if not xs:
+        return 0.0
+    i = min(len(xs) - 1, max(0, round(q * (len(xs) - 1))))
+    return xs[i]
+
+
+def summarize(latencies: list[float], statuses: dict, elapsed: float) -> dict:
+    xs = sorted(latencies)
+    ms = lambda v: round(v * 1000, 3)
+    return {
+        "requests": len(xs),
+        "elapsed_sec": round(elapsed, 3),
+        "rps": round(len(xs) / elapsed, 1) if elapsed > 0 else 0.0,
+        "p50_ms": ms(quantile(xs, 0.50)),
+        "p95_ms": ms(quantile(xs, 0.95)),
+        "p99_ms": ms(quantile(xs, 0.99)),
+        "max_ms": ms(xs[-1]) if xs else 0.0,
+        "status": {str(k): v for k, v in sorted(statuses.items(), key=lambda kv: str(kv[0]))},
+    }
+
+
+# ---------- синтетические апдейты ----------
+_update_ids = itertools.count(1)
+_message_ids = itertools.count(1)
+
+
+def _user(uid: int) -> dict:
+    return {"id": uid, "is_bot": False, "first_name": f"U{uid}", "username": f"bench_u{uid}", "language_code": "ru"}
+
+
+def message_update(uid: int, text: str) -> dict:
+    msg = {"message_id": next(_message_ids), "date": int(time.time()),
+           "chat": {"id": uid, "type": "private"}, "from": _user(uid), "text": text}
+    if text.startswith("/"):
+        msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": next(_update_ids), "message": msg}
+
+
+def callback_update(uid: int, data: str) -> dict:
+    msg = {"message_id": next(_message_ids), "date": int(time.time()),
+           "chat": {"id": uid, "type": "private"}, "from": {"id": 100500, "is_bot": True, "first_name": "Bench"},
+           "text": "menu"}
+    return {"update_id": next(_update_ids),
+            "callback_query": {"id": str(next(_update_ids)), "from": _user(uid), "chat_instance": str(uid),
+                               "message": msg, "data": data}}
+
+
+def init_data(uid: int) -> str:
+    """initData, подписанный тем же BOT_TOKEN, что у поднятого app."""
+    fields = {"auth_date": str(int(time.time())), "query_id": f"AA{uid}",
+              "user": json.dumps(_user(uid), separators=(",", ":"), ensure_ascii=False)}
+    check = "\n".join(f"{k}={v}" for k, v in sorted(fields.items()))
+    key = hmac.new(b"WebAppData", BOT_TOKEN.encode(), hashlib.sha256).digest()
+    fields["hash"] = hmac.new(key, check.encode(), hashlib.sha256).hexdigest()
+    return urlencode(fields)
+
+
+# ---------- прогон ----------
+class Runner:
+    def __init__(self, base: str, http: aiohttp.ClientSession, concurrency: int):
+        self.base = base
+        self.http = http
+        self.sem = asyncio.Semaphore(concurrency)
+        self.latencies: list[float] = []
+        self.statuses: dict = {}
+
+    async def _timed(self, method: str, path: str, **kw) -> None:
+        async with self.sem:
+            t0 = time.perf_counter()
+            try:
+                async with self.http.request(method, self.base + path, **kw) as r:
+                    await r.read()
+                    status = r.status
+            except aiohttp.ClientError as e:
+                status = type(e).__name__
+            self.latencies.append(time.perf_counter() - t0)
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    async def webhook(self, update: dict) -> None:
+        await self._timed("POST", WEBHOOK_PATH, json=update,
+                          headers={"X-Telegram-Bot-Api-Secret-Token": SECRET})
+
+    async def submit(self, uid: int) -> None:
+        payload = {"company": f"Кофейня #{uid}, Казань", "task": "Онлайн-запись и напоминания клиентам",
+                   "contact": f"@bench_u{uid}", "nonce": f"bench-{uid}-{time.monotonic_ns()}"}
+        await self._timed("POST", "/webapp/submit", json=payload,
+                          headers={"X-Telegram-Init-Data": init_data(uid),
+                                   "X-Forwarded-For": f"10.{uid >> 16 & 255}.{uid >> 8 & 255}.{uid & 255}"})
+
+
+async def scenario(name: str, r: Runner, n: int, user_base: int) -> None:
+    uids = range(user_base, user_base + n)
+    if name == "start":
+        await asyncio.gather(*(r.webhook(message_update(u, "/start")) for u in uids))
+    elif name == "callback":
+        await asyncio.gather(*(r.webhook(callback_update(user_base + i % 100, CALLBACKS[i % len(CALLBACKS)]))
+                               for i in range(n)))
+    elif name == "quiz":
+        async def one(u: int) -> None:
+            await r.webhook(callback_update(u, "go_quiz"))
+            for text in ("Барбершоп, Самара", "Запись и напоминания", "2 недели"):
+                await r.webhook(message_update(u, text))
+        await asyncio.gather(*(one(u) for u in range(user_base, user_base + max(1, n // 4))))
+    elif name == "submit":
+        await asyncio.gather(*(r.submit(u) for u in uids))
+    else:
+        raise SystemExit(f"unknown scenario: {name}")
+
+
+async def settle(api: FakeBotAPI, quiet: float, timeout: float) -> float:
+    """Ждём, пока бот перестанет дёргать Bot API; возвращаем момент последнего вызова."""
+    deadline = time.perf_counter() + timeout
+    last_total, last_change = sum(api.calls.values()), time.perf_counter()
+    while time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+        total = sum(api.calls.values())
+        if total != last_total:
+            last_total, last_change = total, time.perf_counter()
+        elif time.perf_counter() - last_change >= quiet:
+            break
+    return last_change
+
+
+async def wait_ready(http: aiohttp.ClientSession, base: str, proc: subprocess.Popen, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise SystemExit(f"app exited with code {proc.returncode}")
+        try:
+            async with http.get(base + "/healthz") as r:
+                if r.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.1)
+    raise SystemExit("app did not become ready")
+
+
+def compare(cur: dict, old_path: str) -> None:
+    with open(old_path, encoding="utf-8") as f:
+        old = json.load(f)
+    print(f"\nvs {old_path} ({old.get('meta', {}).get('git', '?')}):")
+    print(f"{'scenario':<10} {'rps':>10} {'Δ%':>7} {'p95 ms':>10} {'Δ%':>7} {'p99 ms':>10} {'Δ%':>7}")
+    pct = lambda a, b: f"{(a - b) / b * 100:+.1f}" if b else "n/a"
+    for name, s in cur["scenarios"].items():
+        o = old.get("scenarios", {}).get(name)
+        if not o:
+            continue
+        print(f"{name:<10} {s['rps']:>10} {pct(s['rps'], o['rps']):>7} {s['p95_ms']:>10} "
+              f"{pct(s['p95_ms'], o['p95_ms']):>7} {s['p99_ms']:>10} {pct(s['p99_ms'], o['p99_ms']):>7}")
+
+
+async def main(args) -> dict:
+    api = FakeBotAPI(args.latency_ms, args.jitter_ms, args.rate_429, args.retry_after)
+    api_port = await api.start()
+    app_port = args.app_port or free_port()
+    base = f"http://127.0.0.1:{app_port}"
+
+    data_dir = tempfile.mkdtemp(prefix="vimly-bench-")
+    env = {**os.environ,
+           "BOT_TOKEN": BOT_TOKEN, "LEADS_CHAT_ID": LEADS_CHAT, "ADMIN_CHAT_ID": "1",
+           "BASE_URL": base, "WEBHOOK_PATH": WEBHOOK_PATH, "WEBHOOK_SECRET": SECRET, "MODE": "webhook",
+           "TELEGRAM_API_URL": f"http://127.0.0.1:{api_port}", "DATA_DIR": data_dir, "DB_PATH": "",
+           "SUBMIT_RATE_PER_MIN": "1000000000", "SUBMIT_BURST": "1000000000", "LOG_LEVEL": "WARNING",
+           "TRUST_PROXY_HEADERS": "1"}   # как на Render: одна запись X-Forwarded-For от прокси
+    for kv in args.env:
+        k, _, v = kv.partition("=")
+        env[k] = v
+    cmd = [sys.executable, "-m", "uvicorn", "app:app", "--host", "127.0.0.1", "--port", str(app_port),
+           "--log-level", "warning", "--no-access-log"]
+    proc = subprocess.Popen(cmd, cwd=ROOT, env=env)
+
+    result = {"meta": {"git": git_rev(), "at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                       "python": platform.python_version(), "machine": platform.machine(), "cpus": os.cpu_count(),
+                       "args": vars(args)},
+              "scenarios": {}}
+    try:
+        timeout = aiohttp.ClientTimeout(total=60)
+        conn = aiohttp.TCPConnector(limit=args.concurrency)
+        async with aiohttp.ClientSession(timeout=timeout, connector=conn) as http:
+            await wait_ready(http, base, proc)
+            await settle(api, 0.3, 10)   # стартовые getMe/getChatMember/setWebhook
+            for i, name in enumerate(args.scenarios.split(",")):
+                name = name.strip()
+                r = Runner(base, http, args.concurrency)
+                calls0 = sum(api.calls.values())
+                t0 = time.perf_counter()
+                await scenario(name, r, args.requests, user_base=1_000_000 * (i + 1))
+                elapsed = time.perf_counter() - t0
+                last_call = await settle(api, args.settle_quiet, args.settle_timeout)
+                s = summarize(r.latencies, r.statuses, elapsed)
+                s["bot_api_calls"] = sum(api.calls.values()) - calls0
+                s["e2e_sec"] = round(max(elapsed, last_call - t0), 3)
+                result["scenarios"][name] = s
+                print(f"{name:<10} {s['requests']:>6} req  {s['rps']:>8} rps  p50={s['p50_ms']}ms "
+                      f"p95={s['p95_ms']}ms p99={s['p99_ms']}ms  api_calls={s['bot_api_calls']} "
+                      f"e2e={s['e2e_sec']}s  {s['status']}")
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        await api.stop()
+    result["fake_api"] = api.snapshot()
+    return result
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description="Нагрузочный прогон app против стаба Bot API")
+    p.add_argument("--scenarios", default=",".join(SCENARIOS), help="через запятую: " + ",".join(SCENARIOS))
+    p.add_argument("--requests", type=int, default=2000, help="запросов на сценарий (quiz: пользователей = /4)")
+    p.add_argument("--concurrency", type=int, default=100)
+    p.add_argument("--latency-ms", type=float, default=20.0, help="задержка ответа стаба Bot API")
+    p.add_argument("--jitter-ms", type=float, default=5.0)
+    p.add_argument("--rate-429", type=float, default=0.0, help="доля ответов 429 от стаба (0..1)")
+    p.add_argument("--retry-after", type=int, default=1)
+    p.add_argument("--app-port", type=int, default=0)
+    p.add_argument("--settle-quiet", type=float, default=1.0, help="сколько секунд тишины считаем «всё обработано»")
+    p.add_argument("--settle-timeout", type=float, default=120.0)
+    p.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="переопределить env для app")
+    p.add_argument("--out", default=os.path.join(ROOT, "bench", "results"))
+    p.add_argument("--compare", default="", help="JSON предыдущего прогона")
+    args = p.parse_args()
+
+    res = asyncio.run(main(args))
+    os.makedirs(args.out, exist_ok=True)
+    path = os.path.join(args.out, f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{res['meta']['git']}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(res, f, ensure_ascii=False, indent=2)
+    print(f"\nsaved {path}")
+    if args.compare:
+        compare(res, args.compare)
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+"""Webhook не должен падать на типах апдейтов, которых aiogram ещё не знает:
+500 заставит Telegram повторять этот апдейт и застопорит доставку."""
+
+import os, sys, tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("BOT_TOKEN", "123456:TEST-token-not-real")
+os.environ.setdefault("LEADS_CHAT_ID", "-1001000000001")
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="vimly-test-"))
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+from fastapi.testclient import TestClient  # noqa: E402
+from aiogram.types import Update  # noqa: E402
+
+import app  # noqa: E402
+
+UNKNOWN = {"update_id": 5, "some_new_field": {}}
+
+
+def test_unknown_update_type_is_acked(monkeypatch):
+    monkeypatch.setattr(app, "WEBHOOK_SECRET", "")
+    monkeypatch.setattr(app, "WEBHOOK_ACK_FIRST", False)
+    client = TestClient(app.app)
+    r = client.post(app.WEBHOOK_PATH, json=UNKNOWN)
+    assert r.status_code == 200
+
+
+def test_unknown_update_type_is_sharded_by_update_id():
+    update = Update.model_validate(UNKNOWN)
+    assert app._event_type(update) == "unknown"
+    assert app._update_key(update) == 5